@@ -0,0 +1,438 @@
+"""Aggregation engine behind the /analytics and /dashboard pages.
+
+Every section of the page is derived from a handful of grouped queries
+over daily_product_rollup: a per-day series for the user's whole history,
+an all-time per-product ranking and a per-category breakdown for the
+current month. Only the partial first day of the 30-day average reads
+the raw sale table.
+
+The page itself is a shell; each section is served separately as JSON by
+/api/analytics/<section> (see AnalyticsEngine.section) so the browser can
+fill sections in as they arrive.
+"""
+from dataclasses import dataclass, field, fields, asdict
+from datetime import timedelta
+from sqlalchemy import func
+import calendar
+
+from models import db, Product, Sale, DailyProductRollup
+from profit import DIMENSIONS
+from kpi import kpis
+from topk import top_products
+from stock import low_stock_count
+import periods
+
+WEEKDAY_NAMES = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+BUSINESS_HOURS = range(8, 22)  # 08:00-21:59, the heatmap's columns
+
+
+@dataclass
+class DayTotals:
+    """Aggregates for one calendar day."""
+    revenue: float = 0.0
+    transactions: int = 0
+    items: float = 0.0
+    profit: float = 0.0
+
+
+@dataclass
+class WeekdayRow:
+    day: str
+    avg_sales: float
+    transactions: int
+
+
+@dataclass
+class ProductRow:
+    name: str
+    quantity: float
+    revenue: float
+
+
+@dataclass
+class DayRow:
+    date: str
+    day_name: str
+    transactions: int
+    items_sold: float
+    revenue: float
+    profit: float
+    margin: float
+
+
+@dataclass
+class CategoryRow:
+    category: str
+    sales: float
+    revenue: float
+
+
+@dataclass
+class HeatCell:
+    """One weekday x hour bucket, averaged over the weekdays with any sales."""
+    avg_revenue: float = 0.0
+    transactions: int = 0
+    items: float = 0.0
+
+
+@dataclass
+class MonthRow:
+    month: str
+    sales: float
+    profit: float
+
+
+def last_n_months(now, n):
+    """(year, month) pairs for the last n months, oldest first, ending at now's month."""
+    months = []
+    for i in range(n - 1, -1, -1):
+        month = now.month - i
+        year = now.year
+        if month <= 0:
+            month += 12
+            year -= 1
+        months.append((year, month))
+    return months
+
+
+class AnalyticsEngine:
+    """Computes the analytics page for one user as of a fixed point in time."""
+
+    def __init__(self, user_id, now=None):
+        self.user_id = user_id
+        self.now = now or periods.local_now()
+        self._daily = None
+
+    # ===== QUERIES =====
+    def daily_totals(self):
+        """Per-day aggregates over the user's full history: {date: DayTotals}."""
+        if self._daily is not None:
+            return self._daily
+
+        # Rollup cost is built from profit.cogs, so revenue - cost is the app-wide profit
+        R = DailyProductRollup
+        rows = db.session.query(
+            R.day,
+            func.sum(R.revenue).label('revenue'),
+            func.sum(R.txn_count).label('transactions'),
+            func.sum(R.qty).label('items'),
+            func.sum(R.revenue - R.cost).label('profit')
+        ).filter(
+            R.user_id == self.user_id
+        ).group_by(R.day).all()
+
+        self._daily = {
+            r.day: DayTotals(
+                revenue=float(r.revenue or 0),
+                transactions=int(r.transactions or 0),
+                items=float(r.items or 0),
+                profit=float(r.profit or 0)
+            )
+            for r in rows
+        }
+        return self._daily
+
+    def revenue_since(self, cutoff):
+        """Revenue from `cutoff` onwards: whole days from the rollup, the partial first day from sales."""
+        first_day = periods.day(cutoff)
+        partial = db.session.query(func.sum(Sale.total_amount)).filter(
+            Sale.user_id == self.user_id,
+            periods.between(cutoff, first_day.end).where(Sale.date)
+        ).scalar() or 0
+
+        first_full_day = first_day.end_day
+        return float(partial) + sum(t.revenue for d, t in self.daily_totals().items() if d >= first_full_day)
+
+    def top_products(self, limit=5):
+        """All-time best sellers by revenue, from the incrementally maintained ranking."""
+        return [
+            ProductRow(name=p['name'], quantity=p['quantity'], revenue=p['revenue'])
+            for p in top_products.top(self.user_id, 'all', limit, now=self.now)
+        ]
+
+    def category_breakdown(self):
+        """Units and revenue per category for the current calendar month, best first."""
+        R = DailyProductRollup
+        revenue = func.sum(R.revenue)
+        rows = db.session.query(
+            Product.category,
+            func.sum(R.qty).label('qty'),
+            revenue.label('rev')
+        ).join(Product, Product.id == R.product_id).filter(
+            R.user_id == self.user_id,
+            periods.this_month(self.now).where_day(R.day),
+            Product.category.isnot(None),
+            Product.category != ''
+        ).group_by(Product.category).order_by(revenue.desc(), Product.category).all()
+
+        return [CategoryRow(category=r.category, sales=float(r.qty or 0), revenue=float(r.rev or 0)) for r in rows]
+
+    def weekday_hour_totals(self):
+        """Revenue, sale count and units per (weekday, hour) over all time.
+
+        Grouped in SQL with strftime('%w') / strftime('%H'), so the result is
+        at most 7 x 24 rows however long the sales history gets. Weekdays are
+        returned Monday = 0 like date.weekday().
+        """
+        weekday, hour = DIMENSIONS['weekday'], DIMENSIONS['hour']
+        rows = db.session.query(
+            weekday.label('weekday'),
+            hour.label('hour'),
+            func.sum(Sale.total_amount).label('revenue'),
+            func.count(Sale.id).label('transactions'),
+            func.sum(Sale.quantity).label('items')
+        ).filter(
+            Sale.user_id == self.user_id,
+            Sale.date.isnot(None)
+        ).group_by(weekday, hour).all()
+
+        return {
+            ((int(r.weekday) + 6) % 7, int(r.hour)): (float(r.revenue or 0), int(r.transactions), float(r.items or 0))
+            for r in rows
+        }
+
+    def heatmap(self, hours=BUSINESS_HOURS):
+        """7 x len(hours) grid of HeatCell, Monday first.
+
+        Averages divide by the number of days of that weekday with any sales,
+        so a cell reads "a typical Tuesday at 18:00".
+        """
+        active_days = [0] * 7
+        for day in self.daily_totals():
+            active_days[day.weekday()] += 1
+
+        totals = self.weekday_hour_totals()
+        grid = []
+        for weekday in range(7):
+            days = active_days[weekday]
+            row = []
+            for hour in hours:
+                revenue, transactions, items = totals.get((weekday, hour), (0.0, 0, 0.0))
+                row.append(HeatCell(
+                    avg_revenue=revenue / days if days else 0.0,
+                    transactions=transactions,
+                    items=items
+                ))
+            grid.append(row)
+        return grid
+
+    # ===== SECTIONS =====
+    def _month_totals(self, year, month):
+        """(revenue, profit) for a calendar month, summed from the daily series."""
+        revenue = profit = 0.0
+        for day, totals in self.daily_totals().items():
+            if day.year == year and day.month == month:
+                revenue += totals.revenue
+                profit += totals.profit
+        return revenue, profit
+
+    def daily_chart(self, days=30):
+        daily = self.daily_totals()
+        labels, data = [], []
+        for date in periods.last_n_days(days, self.now).days():
+            totals = daily.get(date)
+            labels.append(date.strftime('%d %b'))
+            data.append(totals.revenue if totals else 0.0)
+        return labels, data
+
+    def monthly_series(self, months=6):
+        """[(abbr, revenue, profit)] for the last `months` calendar months."""
+        return [
+            (calendar.month_abbr[month],) + self._month_totals(year, month)
+            for year, month in last_n_months(self.now, months)
+        ]
+
+    def weekday_analysis(self):
+        """Average sale value and sale count per weekday over all time."""
+        revenue = [0.0] * 7
+        count = [0] * 7
+        for day, totals in self.daily_totals().items():
+            weekday = day.weekday()
+            revenue[weekday] += totals.revenue
+            count[weekday] += totals.transactions
+
+        rows = []
+        max_avg_sales = 1  # Prevent division by zero in template
+        for day_num in range(7):
+            avg_sales = revenue[day_num] / count[day_num] if count[day_num] else 0
+            max_avg_sales = max(max_avg_sales, avg_sales)
+            rows.append(WeekdayRow(day=WEEKDAY_NAMES[day_num], avg_sales=avg_sales, transactions=count[day_num]))
+        return rows, max_avg_sales
+
+    def last_7_days(self):
+        daily = self.daily_totals()
+        rows = []
+        for date in periods.last_n_days(7, self.now).days():
+            totals = daily.get(date)
+            if totals:
+                margin = round((totals.profit / totals.revenue * 100) if totals.revenue > 0 else 0, 1)
+                rows.append(DayRow(date.strftime('%d %b'), date.strftime('%A'), totals.transactions,
+                                   totals.items, totals.revenue, totals.profit, margin))
+            else:
+                rows.append(DayRow(date.strftime('%d %b'), date.strftime('%A'), 0, 0, 0, 0, 0))
+        return rows
+
+    def summary(self):
+        """Summary cards and metrics row."""
+        now = self.now
+        daily = self.daily_totals()
+
+        kpi = kpis.get(self.user_id, now)
+        monthly_sales = kpi['month_to_date']
+        _, monthly_profit = self._month_totals(now.year, now.month)
+        total_transactions = kpi['transactions']
+
+        summary = {
+            'current_month': calendar.month_name[now.month],
+            'today_date_formatted': now.strftime('%d %B %Y'),
+            'today_sales': kpi['today'],
+            'monthly_sales': monthly_sales,
+            'monthly_profit': monthly_profit,
+            'profit_margin': round((monthly_profit / monthly_sales * 100) if monthly_sales > 0 else 0, 1),
+            'avg_daily': self.revenue_since(now - timedelta(days=30)) / 30,
+            'best_day': 0.0,
+            'best_day_date': 'N/A',
+            'ytd_sales': kpi['year_to_date'],
+            'avg_transaction': (monthly_sales / total_transactions) if total_transactions > 0 else 0,
+            'unique_days': len(daily),
+        }
+        if daily:
+            best_date, best = max(daily.items(), key=lambda item: item[1].revenue)
+            summary['best_day'] = best.revenue
+            summary['best_day_date'] = best_date.strftime('%Y-%m-%d')
+        return summary
+
+    # JSON payload builders for /api/analytics/<section>
+    def _daily_section(self):
+        labels, data = self.daily_chart()
+        return {'labels': labels, 'data': data}
+
+    def _monthly_section(self):
+        months = self.monthly_series()
+        return {'rows': [asdict(MonthRow(month=m[0], sales=m[1], profit=m[2])) for m in months]}
+
+    def _weekday_section(self):
+        rows, max_avg_sales = self.weekday_analysis()
+        return {'rows': [asdict(r) for r in rows], 'max_avg_sales': max_avg_sales}
+
+    def _top_products_section(self):
+        return {'rows': [asdict(r) for r in self.top_products()]}
+
+    def _categories_section(self):
+        rows = self.category_breakdown()
+        return {
+            'rows': [asdict(r) for r in rows],
+            'max_category_revenue': max([1] + [r.revenue for r in rows])
+        }
+
+    def _heatmap_section(self):
+        grid = self.heatmap()
+        return {
+            'days': WEEKDAY_NAMES,
+            'hours': list(BUSINESS_HOURS),
+            'cells': [[asdict(cell) for cell in row] for row in grid],
+            'max_avg_revenue': max([1] + [cell.avg_revenue for row in grid for cell in row])
+        }
+
+    def _last_7_days_section(self):
+        return {'rows': [asdict(r) for r in self.last_7_days()]}
+
+    SECTIONS = {
+        'summary': summary,
+        'daily': _daily_section,
+        'monthly': _monthly_section,
+        'weekday': _weekday_section,
+        'heatmap': _heatmap_section,
+        'top_products': _top_products_section,
+        'categories': _categories_section,
+        'last_7_days': _last_7_days_section,
+    }
+
+    def section(self, name):
+        """JSON-serialisable payload for one page section. Raises KeyError for unknown names."""
+        return self.SECTIONS[name](self)
+
+
+@dataclass
+class DashboardResult:
+    """Everything the dashboard template renders apart from the session user."""
+    total_today: float = 0
+    total_month: float = 0
+    total_products: int = 0
+    low_stock: int = 0
+    recent_sales: list = field(default_factory=list)
+    daily_labels: list = field(default_factory=list)
+    daily_data: list = field(default_factory=list)
+    top_products: list = field(default_factory=list)
+
+    def as_context(self):
+        """Shallow mapping of fields for render_template(**...)."""
+        return {f.name: getattr(self, f.name) for f in fields(self)}
+
+    def live_fields(self):
+        """JSON-safe subset pushed to /dashboard/stream subscribers."""
+        return {
+            'total_today': float(self.total_today or 0),
+            'total_month': float(self.total_month or 0),
+            'total_products': self.total_products,
+            'low_stock': self.low_stock,
+            'recent_sales': [
+                dict(s, quantity=float(s['quantity'] or 0), total=float(s['total'] or 0))
+                for s in self.recent_sales
+            ],
+            'top_products': [
+                dict(p, quantity=float(p['quantity'] or 0), revenue=float(p['revenue'] or 0))
+                for p in self.top_products
+            ],
+        }
+
+
+def dashboard_summary(user_id):
+    """Compute the /dashboard cards, chart and tables for one user."""
+    result = DashboardResult()
+
+    # Today's and this month's sales from the running KPI counters
+    kpi = kpis.get(user_id)
+    result.total_today = kpi['today']
+    result.total_month = kpi['month_to_date']
+
+    # Total products and Low stock (partial index holds only the low rows)
+    result.total_products = Product.query.filter_by(user_id=user_id).count()
+    result.low_stock = low_stock_count(user_id)
+
+    # Recent sales (Joined query to avoid N+1)
+    recent_sales = db.session.query(Sale, Product.name).join(Product).filter(
+        Sale.user_id == user_id
+    ).order_by(Sale.date.desc()).limit(5).all()
+
+    for sale, product_name in recent_sales:
+        result.recent_sales.append({
+            'product_name': product_name,
+            'quantity': sale.quantity,
+            'total': sale.total_amount,
+            'time': sale.date.strftime('%H:%M')
+        })
+
+    # Chart Data (Last 30 Days) from the rollup (one row per product per day)
+    R = DailyProductRollup
+    last_30_days = periods.last_n_days(30)
+    daily_sales_query = db.session.query(
+        R.day,
+        func.sum(R.revenue).label('total')
+    ).filter(
+        R.user_id == user_id,
+        last_30_days.where_day(R.day)
+    ).group_by(R.day).all()
+
+    # Map query results to dictionary for O(1) lookup
+    sales_map = {r.day: r.total for r in daily_sales_query}
+    for date in last_30_days.days():
+        result.daily_labels.append(date.strftime('%d %b'))
+        result.daily_data.append(sales_map.get(date, 0))
+
+    # Top Products from the incrementally maintained ranking
+    result.top_products = [
+        {'name': p['name'], 'quantity': p['quantity'], 'revenue': p['revenue']}
+        for p in top_products.top(user_id, 'all', 5)
+    ]
+    return result
@@ -1,13 +1,16 @@
-from flask import Flask, render_template, request, redirect, session, url_for, jsonify
+from flask import Flask, render_template, request, redirect, session, url_for, jsonify, flash, Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime, timedelta
-from sqlalchemy import func, extract, desc, text
+from sqlalchemy import text, and_, or_, literal, type_coerce, String
 import calendar
 import math
 import os
 import sys
 import random
 import json
+import queue
+import time
+import click
 from werkzeug.security import generate_password_hash, check_password_hash
 
 def resource_path(relative_path):
@@ -62,9 +65,26 @@ else:
     app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
     print(f" * Development Mode: Using database at {db_path}")
 
+# Point the app at another database (the tests use a scratch file)
+if os.environ.get('SHOPEASE_DATABASE_URI'):
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['SHOPEASE_DATABASE_URI']
+
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
-from models import db, User, Product, StockIn, Sale, Customer, KhataEntry, Transaction
+from models import db, User, Product, StockIn, Sale, Customer, KhataEntry, Transaction, StockMovement, CustomerProfile
+from analytics_engine import AnalyticsEngine, dashboard_summary
+from cache import cached, result_cache, invalidate_all
+from catalog import catalog
+from search import search_products
+from barcodes import lookup as lookup_barcode, normalize as normalize_barcode, read_barcode_csv, import_barcodes
+from events import bus, format_sse
+from kpi import kpis
+from topk import top_products
+from rollup import record_sale, rebuild_daily_rollup, ensure_daily_rollup
+from stock import take_stock, add_stock, adjust_stock, watchlist
+from upi import qr_images
+from ledger import ensure_stock_ledger, rebuild_stock_ledger, reconcile_current_stock, resync_sale_dates, stock_levels
+import periods
 db.init_app(app)
 
 # Register Blueprints
@@ -72,7 +92,7 @@ from blueprints.prediction import prediction_bp
 from blueprints.reports import reports_bp
 from blueprints.payment import payment_bp
 from blueprints.billing import billing_bp
-from blueprints.customers import customers_bp
+from blueprints.customers import customers_bp, CUSTOMERS_FILE, read_customers_file, import_customers
 from blueprints.khatabook import khatabook_bp
 from blueprints.transactions import transactions_bp
 app.register_blueprint(prediction_bp)
@@ -83,9 +103,32 @@ app.register_blueprint(customers_bp)
 app.register_blueprint(khatabook_bp)
 app.register_blueprint(transactions_bp)
 
+def upgrade_schema():
+    """Adds columns that create_all() cannot add to tables that already exist."""
+    columns = {row[1] for row in db.session.execute(text('PRAGMA table_info(product)'))}
+    if 'reorder_level' not in columns:
+        db.session.execute(text('ALTER TABLE product ADD COLUMN reorder_level FLOAT NOT NULL DEFAULT 10'))
+    if 'barcode' not in columns:
+        db.session.execute(text('ALTER TABLE product ADD COLUMN barcode VARCHAR(64)'))
+    db.session.execute(text(
+        'CREATE INDEX IF NOT EXISTS idx_product_low_stock ON product (user_id, current_stock) '
+        'WHERE current_stock < reorder_level'
+    ))
+    db.session.execute(text('CREATE UNIQUE INDEX IF NOT EXISTS idx_product_user_barcode ON product (user_id, barcode)'))
+    indexes = {row[1] for row in db.session.execute(text('PRAGMA index_list("transaction")'))}
+    if 'idx_transaction_user_ref' not in indexes:
+        # Minute-based numbers repeated within a minute: keep the first, suffix the rest with their id
+        db.session.execute(text(
+            'UPDATE "transaction" SET txn_ref = txn_ref || \'-\' || id '
+            'WHERE id NOT IN (SELECT min(id) FROM "transaction" GROUP BY user_id, txn_ref)'
+        ))
+        db.session.execute(text('CREATE UNIQUE INDEX idx_transaction_user_ref ON "transaction" (user_id, txn_ref)'))
+    db.session.commit()
+
 # Create tables
 with app.app_context():
     db.create_all()
+    upgrade_schema()
 
 # Routes
 @app.route('/')
@@ -143,98 +186,55 @@ def dashboard():
         return redirect('/login')
     
     user_id = session['user_id']
-    
-    # Today's sales (Optimized)
-    today = datetime.now().date()
-    today_sales_total = db.session.query(func.sum(Sale.total_amount)).filter(
-        func.date(Sale.date) == today,
-        Sale.user_id == user_id
-    ).scalar() or 0
-    
-    # This month's sales (Optimized)
-    current_month = datetime.now().month
-    current_year = datetime.now().year
-    month_sales_total = db.session.query(func.sum(Sale.total_amount)).filter(
-        extract('month', Sale.date) == current_month,
-        extract('year', Sale.date) == current_year,
-        Sale.user_id == user_id
-    ).scalar() or 0
-    
-    # Total products and Low stock (Efficient count)
-    total_products = Product.query.filter_by(user_id=user_id).count()
-    
-    low_stock = Product.query.filter(
-        Product.user_id == user_id,
-        Product.current_stock < 10
-    ).count()
-    
-    # Recent sales (Joined query to avoid N+1)
-    recent_sales = db.session.query(Sale, Product.name).join(Product).filter(
-        Sale.user_id == user_id
-    ).order_by(Sale.date.desc()).limit(5).all()
-    
-    recent_sales_data = []
-    for sale, product_name in recent_sales:
-        recent_sales_data.append({
-            'product_name': product_name,
-            'quantity': sale.quantity,
-            'total': sale.total_amount,
-            'time': sale.date.strftime('%H:%M')
-        })
-    
-    
-    # Chart Data (Last 30 Days)
-    daily_labels = []
-    daily_data = []
-    thirty_days_ago = datetime.now() - timedelta(days=30)
-    
-    # Query daily totals efficiently
-    daily_sales_query = db.session.query(
-        func.date(Sale.date).label('date'),
-        func.sum(Sale.total_amount).label('total')
-    ).filter(
-        Sale.user_id == user_id,
-        Sale.date >= thirty_days_ago
-    ).group_by(func.date(Sale.date)).all()
-    
-    # Map query results to dictionary for O(1) lookup
-    sales_map = {r.date: r.total for r in daily_sales_query}
-    
-    # Generate last 30 days list
-    for i in range(29, -1, -1):
-        date = datetime.now() - timedelta(days=i)
-        date_str = date.strftime('%Y-%m-%d')
-        label = date.strftime('%d %b')
-        total = sales_map.get(date_str, 0)
-        
-        daily_labels.append(label)
-        daily_data.append(total)
-        
-    # Top Products
-    top_products_query = db.session.query(
-        Product.name,
-        func.sum(Sale.quantity).label('qty'),
-        func.sum(Sale.total_amount).label('rev')
-    ).join(Sale).filter(
-        Sale.user_id == user_id
-    ).group_by(Product.id).order_by(desc('rev')).limit(5).all()
-    
-    top_products_data = [
-        {'name': p.name, 'quantity': p.qty, 'revenue': p.rev} 
-        for p in top_products_query
-    ]
+    result = cached('dashboard', user_id, lambda: dashboard_summary(user_id), periods.local_now().date())
 
-    return render_template('dashboard.html', 
+    return render_template('dashboard.html',
                          username=session['username'],
-                         total_today=today_sales_total,
-                         total_month=month_sales_total,
-                         total_products=total_products,
-                         low_stock=low_stock,
-                         recent_sales=recent_sales_data,
-                         daily_labels=daily_labels,
-                         daily_data=daily_data,
-                         top_products=top_products_data,
-                         datetime=datetime)
+                         datetime=datetime,
+                         **result.as_context())
+
+# Live dashboard: streams are closed after STREAM_MAX_AGE so the browser
+# reconnects, which also lets each gunicorn worker's bus pick up writes made
+# in other workers and frees long-held threads.
+STREAM_KEEPALIVE = 15
+STREAM_MAX_AGE = 300
+
+@app.route('/dashboard/stream')
+def dashboard_stream():
+    if 'user_id' not in session:
+        return jsonify({'error': 'login required'}), 401
+
+    user_id = session['user_id']
+
+    def snapshot():
+        result = cached('dashboard', user_id, lambda: dashboard_summary(user_id), periods.local_now().date())
+        # Hand the connection back to the pool while the stream sits idle
+        db.session.remove()
+        return result.live_fields()
+
+    @stream_with_context
+    def events():
+        inbox = bus.subscribe(user_id)
+        try:
+            last = snapshot()
+            yield format_sse(last, event='snapshot', retry=3000)
+            deadline = time.monotonic() + STREAM_MAX_AGE
+            while time.monotonic() < deadline:
+                try:
+                    inbox.get(timeout=STREAM_KEEPALIVE)
+                except queue.Empty:
+                    yield format_sse(comment='keepalive')
+                    continue
+                current = snapshot()
+                delta = {k: v for k, v in current.items() if last.get(k) != v}
+                if delta:
+                    yield format_sse(delta, event='delta')
+                last = current
+        finally:
+            bus.unsubscribe(user_id, inbox)
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 # ============= INVENTORY (SALES ENTRY) =============
 @app.route('/inventory', methods=['GET', 'POST'])
@@ -248,54 +248,97 @@ def inventory():
         product_id = request.form['product_id']
         quantity = float(request.form['quantity'])
         
-        product = Product.query.get(product_id)
+        product = catalog.product(user_id, product_id)
+        if product is None:
+            return "Product not found!"
         
-        if product.current_stock >= quantity:
-            total = quantity * product.selling_price
-            
-            sale = Sale(
-                product_id=product_id,
-                quantity=quantity,
-                selling_price=product.selling_price,
-                cost_at_sale=product.cost_price,
-                total_amount=total,
-                user_id=user_id
-            )
-            
-            product.current_stock -= quantity
-            
-            db.session.add(sale)
+        total = quantity * float(product.selling_price)
+        sale = Sale(
+            product_id=product_id,
+            quantity=quantity,
+            selling_price=product.selling_price,
+            cost_at_sale=product.cost_price,
+            total_amount=total,
+            date=periods.local_now(),
+            user_id=user_id
+        )
+        db.session.add(sale)
+        record_sale(sale, product)
+        db.session.flush()
+        
+        # Check and decrement in one UPDATE so concurrent counters can't oversell
+        if take_stock(product_id, quantity, ref_id=sale.id):
             db.session.commit()
-            
             return redirect('/inventory')
         else:
+            db.session.rollback()
+            product = Product.query.get(product_id)
             return f"Not enough stock! Available: {product.current_stock}"
     
     # Get all products for dropdown
-    products = Product.query.filter_by(user_id=user_id).all()
+    products = catalog.products(user_id)
     
-    # Get today's sales
-    today = datetime.now().date()
-    today_sales = Sale.query.filter(
-        func.date(Sale.date) == today,
-        Sale.user_id == user_id
-    ).order_by(Sale.date.desc()).all()
-    
-    sales_with_names = []
-    for sale in today_sales:
-        product = Product.query.get(sale.product_id)
-        sales_with_names.append({
-            'product_name': product.name if product else 'Unknown',
-            'quantity': sale.quantity,
-            'total': sale.total_amount,
-            'time': sale.date.strftime('%H:%M')
-        })
+    # First page of today's sales; the rest load on demand from /api/inventory/sales
+    sales_with_names, next_cursor = todays_sales_page(user_id)
     
     return render_template('inventory.html', 
                          products=products,
                          sales=sales_with_names,
+                         next_cursor=next_cursor,
                          datetime=datetime)
 
+SALES_PAGE_SIZE = 50
+
+def todays_sales_page(user_id, cursor=None, limit=SALES_PAGE_SIZE):
+    """One page of today's sales, newest first, with product names joined in.
+
+    Keyset pagination on (date, id): `cursor` is the next_cursor of the
+    previous page, so every page is an index range scan on
+    idx_sale_user_date however many sales the day has.
+    Returns (rows, next_cursor); next_cursor is None on the last page.
+    """
+    # Compare on the stored text itself: ORDER BY sorts the raw strings, and
+    # rows written by the ORM and by the generator format fractions differently
+    stored_date = type_coerce(Sale.date, String)
+    query = db.session.query(
+        Sale.id, Sale.date, stored_date.label('stamp'), Sale.quantity, Sale.total_amount, Product.name
+    ).outerjoin(Product, Product.id == Sale.product_id).filter(
+        Sale.user_id == user_id,
+        periods.today().where(Sale.date)
+    )
+    if cursor:
+        stamp, _, last_id = cursor.rpartition('_')
+        datetime.fromisoformat(stamp)  # reject anything that is not a timestamp
+        before = literal(stamp, String)
+        query = query.filter(
+            stored_date <= before,  # lets the index range start at the cursor
+            or_(stored_date < before, and_(stored_date == before, Sale.id < int(last_id)))
+        )
+
+    rows = query.order_by(Sale.date.desc(), Sale.id.desc()).limit(limit + 1).all()
+    page = [{
+        'product_name': r.name or 'Unknown',
+        'quantity': r.quantity,
+        'total': float(r.total_amount or 0),
+        'time': r.date.strftime('%H:%M')
+    } for r in rows[:limit]]
+
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = f'{last.stamp}_{last.id}'
+    return page, next_cursor
+
+@app.route('/api/inventory/sales')
+def inventory_sales_page():
+    if 'user_id' not in session:
+        return jsonify({'error': 'login required'}), 401
+    try:
+        sales, next_cursor = todays_sales_page(session['user_id'], request.args.get('cursor'))
+    except ValueError:
+        return jsonify({'error': 'invalid cursor'}), 400
+    return jsonify({'sales': sales, 'next_cursor': next_cursor})
+
 # ============= STOCK MANAGEMENT =============
 @app.route('/stock', methods=['GET', 'POST'])
 def stock():
@@ -313,45 +356,90 @@ def stock():
             unit = request.form['unit']
             selling_price = float(request.form['selling_price'])
             cost_price = float(request.form['cost_price'])
+            barcode = normalize_barcode(request.form.get('barcode')) or None
             
-            new_product = Product(
-                name=name,
-                category=category,
-                unit=unit,
-                selling_price=selling_price,
-                cost_price=cost_price,
-                current_stock=0,
-                user_id=user_id
-            )
-            db.session.add(new_product)
-            db.session.commit()
+            holder = lookup_barcode(user_id, barcode)
+            if holder is not None:
+                flash(f"Barcode {barcode} already belongs to {holder.name}.", 'danger')
+            else:
+                new_product = Product(
+                    name=name,
+                    category=category,
+                    unit=unit,
+                    selling_price=selling_price,
+                    cost_price=cost_price,
+                    current_stock=0,
+                    barcode=barcode,
+                    user_id=user_id
+                )
+                db.session.add(new_product)
+                db.session.commit()
             
         elif action == 'stock_in':
-            product_id = request.form['product_id']
+            product_id = Product.query.filter_by(id=request.form['product_id'], user_id=user_id).first_or_404().id
             quantity = float(request.form['quantity'])
             cost_price = float(request.form['cost_price'])
             
-            product = Product.query.get(product_id)
-            product.current_stock += quantity
-            
             stock_entry = StockIn(
                 product_id=product_id,
                 quantity=quantity,
                 cost_price=cost_price,
+                date=periods.local_now(),
                 user_id=user_id
             )
             db.session.add(stock_entry)
-            db.session.commit()
+            db.session.flush()
+            if add_stock(product_id, quantity, ref_id=stock_entry.id):
+                db.session.commit()
+            else:
+                db.session.rollback()
+        
+        elif action == 'adjust':
+            product_id = Product.query.filter_by(id=request.form['product_id'], user_id=user_id).first_or_404().id
+            delta = float(request.form['delta'])
+            note = request.form.get('note', '').strip() or None
+            
+            if adjust_stock(product_id, delta, note=note):
+                db.session.commit()
+            else:
+                db.session.rollback()
+                flash('Adjustment would take stock below zero.', 'danger')
+        
+        elif action == 'import_barcodes':
+            upload = request.files.get('barcode_file')
+            if not upload or not upload.filename:
+                flash('Choose a CSV file of product, barcode rows.', 'danger')
+            else:
+                try:
+                    labelled, errors = import_barcodes(user_id, read_barcode_csv(upload.stream))
+                except UnicodeDecodeError:
+                    labelled, errors = 0, ['The file is not UTF-8 text.']
+                for error in errors[:10]:
+                    flash(error, 'danger')
+                if len(errors) > 10:
+                    flash(f'...and {len(errors) - 10} more problems.', 'danger')
+                if labelled:
+                    flash(f'Barcodes assigned to {labelled} products.', 'success')
+        
+        elif action == 'reorder_level':
+            product = Product.query.filter_by(id=request.form['product_id'], user_id=user_id).first()
+            reorder_level = float(request.form['reorder_level'])
+            
+            if product is None or reorder_level < 0:
+                flash('Reorder level must be zero or more.', 'danger')
+            else:
+                product.reorder_level = reorder_level
+                db.session.commit()
     
     # Get all products
-    products = Product.query.filter_by(user_id=user_id).all()
+    products = catalog.products(user_id)
     
     # Get recent stock in entries
     recent_stock = StockIn.query.filter_by(user_id=user_id).order_by(StockIn.date.desc()).limit(10).all()
     
     stock_with_names = []
     for entry in recent_stock:
-        product = Product.query.get(entry.product_id)
+        product = catalog.product(user_id, entry.product_id)
         stock_with_names.append({
             'product_name': product.name if product else 'Unknown',
             'quantity': entry.quantity,
@@ -367,305 +455,142 @@ def analytics():
     if 'user_id' not in session:
         return redirect('/login')
     
+    # Shell only: the sections load themselves from /api/analytics/<section>
+    now = periods.local_now()
+    return render_template('analytics.html',
+                         now=now,
+                         current_month=calendar.month_name[now.month],
+                         today_date_formatted=now.strftime('%d %B %Y'))
+
+@app.route('/api/analytics/<section>')
+def analytics_section(section):
+    if 'user_id' not in session:
+        return jsonify({'error': 'login required'}), 401
+    if section not in AnalyticsEngine.SECTIONS:
+        return jsonify({'error': f'unknown section {section!r}'}), 404
+
     user_id = session['user_id']
+    payload = cached(f'analytics:{section}', user_id,
+                     lambda: AnalyticsEngine(user_id).section(section),
+                     periods.local_now().date())
+
+    # ETag over the payload lets the browser revalidate with a 304 until data changes
+    response = jsonify(payload)
+    response.add_etag()
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+@app.route('/api/cache_stats')
+def cache_stats():
+    if 'user_id' not in session:
+        return jsonify({'error': 'login required'}), 401
+    return jsonify(dict(result_cache.stats(), live_streams=bus.subscriber_count(), catalog=catalog.stats(), qr_codes=qr_images.stats()))
+
+@app.route('/api/top_products')
+def top_products_api():
+    if 'user_id' not in session:
+        return jsonify({'error': 'login required'}), 401
+    user_id = session['user_id']
+    window = request.args.get('window', 'all')
+    by = request.args.get('by', 'revenue')
+    k = min(request.args.get('k', 5, type=int), 50)
+    try:
+        if request.args.get('rebuild'):
+            top_products.rebuild(user_id)
+        rows = top_products.top(user_id, window, k, by)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'window': window, 'by': by, 'products': rows})
+
+@app.route('/api/stock/<int:product_id>')
+def stock_history(product_id):
+    """Stock level now (or ?as_of=YYYY-MM-DD[THH:MM]) and the latest ledger rows."""
+    if 'user_id' not in session:
+        return jsonify({'error': 'login required'}), 401
+    product = Product.query.filter_by(id=product_id, user_id=session['user_id']).first()
+    if product is None:
+        return jsonify({'error': 'product not found'}), 404
     
-    # Get current date info
-    now = datetime.now()
-    current_month = now.month
-    current_year = now.year
-    current_month_name = calendar.month_name[current_month]
-    today_date_formatted = now.strftime('%d %B %Y')
-    
-    # ===== TODAY'S SALES =====
-    today = now.date()
-    today_sales_data = Sale.query.filter(
-        func.date(Sale.date) == today,
-        Sale.user_id == user_id
-    ).all()
-    today_sales = float(sum(sale.total_amount for sale in today_sales_data) or 0)
-    
-    # ===== THIS MONTH'S SALES =====
-    monthly_sales_data = Sale.query.filter(
-        extract('month', Sale.date) == current_month,
-        extract('year', Sale.date) == current_year,
-        Sale.user_id == user_id
-    ).all()
-    monthly_sales = float(sum(sale.total_amount for sale in monthly_sales_data) or 0)
-    
-    # ===== AVERAGE DAILY SALES (LAST 30 DAYS) =====
-    thirty_days_ago = now - timedelta(days=30)
-    last_30_days_sales = Sale.query.filter(
-        Sale.date >= thirty_days_ago,
-        Sale.user_id == user_id
-    ).all()
-    
-    if last_30_days_sales:
-        avg_daily = float(sum(s.total_amount for s in last_30_days_sales)) / 30
-    else:
-        avg_daily = 0
-    
-    # ===== BEST DAY EVER =====
-    best_day_data = db.session.query(
-        func.date(Sale.date).label('sale_date'),
-        func.sum(Sale.total_amount).label('daily_total')
-    ).filter(
-        Sale.user_id == user_id
-    ).group_by(
-        func.date(Sale.date)
-    ).order_by(
-        func.sum(Sale.total_amount).desc()
-    ).first()
-    
-    if best_day_data:
-        best_day = float(best_day_data.daily_total)
-        # The date is already a string from func.date()
-        best_day_date = best_day_data.sale_date  # Format: YYYY-MM-DD
+    as_of = request.args.get('as_of')
+    try:
+        as_of = datetime.fromisoformat(as_of) if as_of else None
+    except ValueError:
+        return jsonify({'error': 'as_of must be an ISO date or datetime'}), 400
+    
+    movements = StockMovement.query.filter_by(product_id=product_id).order_by(
+        StockMovement.date.desc(), StockMovement.id.desc()
+    ).limit(20).all()
+    return jsonify({
+        'product_id': product_id,
+        'current_stock': float(product.current_stock or 0),
+        'ledger_stock': stock_levels(as_of, [product_id]).get(product_id, 0.0),
+        'as_of': as_of.isoformat() if as_of else None,
+        'movements': [{
+            'date': m.date.isoformat(sep=' ', timespec='seconds'),
+            'kind': m.kind,
+            'delta': m.delta,
+            'ref_id': m.ref_id,
+            'note': m.note
+        } for m in movements]
+    })
+
+@app.route('/api/products/search')
+def product_search():
+    """Billing counter lookup: ?q= words (prefixes, one typo allowed), ?n= results."""
+    if 'user_id' not in session:
+        return jsonify({'error': 'login required'}), 401
+    limit = max(1, min(request.args.get('n', 10, type=int), 50))
+    products = search_products(session['user_id'], request.args.get('q', ''), limit)
+    return jsonify({'products': [{
+        'id': p.id,
+        'name': p.name,
+        'category': p.category,
+        'unit': p.unit,
+        'price': float(p.selling_price or 0),
+        'stock': float(p.current_stock or 0)
+    } for p in products]})
+
+@app.route('/api/products/barcode/<path:code>')
+def product_by_barcode(code):
+    """Resolve a scanned code to a cart line for the billing page."""
+    if 'user_id' not in session:
+        return jsonify({'error': 'login required'}), 401
+    product = lookup_barcode(session['user_id'], code)
+    if product is None:
+        return jsonify({'error': 'unknown barcode'}), 404
+    return jsonify({
+        'id': product.id,
+        'name': product.name,
+        'category': product.category,
+        'unit': product.unit,
+        'price': float(product.selling_price or 0),
+        'stock': float(product.current_stock or 0),
+        'barcode': product.barcode
+    })
+
+@app.route('/api/stock/watchlist')
+def stock_watchlist():
+    """Products below their reorder level, most urgent first."""
+    if 'user_id' not in session:
+        return jsonify({'error': 'login required'}), 401
+    items = watchlist(session['user_id'])
+    return jsonify({'count': len(items), 'products': items})
+
+@app.route('/api/kpis')
+def kpi_values():
+    if 'user_id' not in session:
+        return jsonify({'error': 'login required'}), 401
+    user_id = session['user_id']
+    if request.args.get('reconcile'):
+        values = kpis.reconcile(user_id)
     else:
-        best_day = 0
-        best_day_date = 'N/A'
-    
-    # ===== DAILY SALES FOR CHART (LAST 30 DAYS) =====
-    daily_labels = []
-    daily_data = []
-    
-    for i in range(29, -1, -1):
-        date = now - timedelta(days=i)
-        date_str = date.strftime('%Y-%m-%d')
-        day_sales = Sale.query.filter(
-            func.date(Sale.date) == date_str,
-            Sale.user_id == user_id
-        ).all()
-        daily_total = float(sum(s.total_amount for s in day_sales) or 0)
-        
-        daily_labels.append(date.strftime('%d %b'))
-        daily_data.append(daily_total)
-    
-    # ===== MONTHLY SALES FOR CHART =====
-    monthly_labels = []
-    monthly_data = []
-    
-    for i in range(5, -1, -1):
-        month = current_month - i
-        year = current_year
-        if month <= 0:
-            month += 12
-            year -= 1
-        
-        month_sales = Sale.query.filter(
-            extract('month', Sale.date) == month,
-            extract('year', Sale.date) == year,
-            Sale.user_id == user_id
-        ).all()
-        month_total = float(sum(s.total_amount for s in month_sales) or 0)
-        
-        monthly_labels.append(calendar.month_abbr[month])
-        monthly_data.append(month_total)
-    
-    # ===== WEEKDAY ANALYSIS =====
-    weekday_names = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
-    weekday_analysis = []
-    
-    weekday_totals = {0: [], 1: [], 2: [], 3: [], 4: [], 5: [], 6: []}
-    
-    all_sales = Sale.query.filter_by(user_id=user_id).all()
-    
-    for sale in all_sales:
-        weekday_num = sale.date.weekday()
-        weekday_totals[weekday_num].append(sale.total_amount)
-    
-    max_avg_sales = 1  # Prevent division by zero in template
-    for day_num in range(7):
-        if weekday_totals[day_num]:
-            avg_sales = sum(weekday_totals[day_num]) / len(weekday_totals[day_num])
-            transactions = len(weekday_totals[day_num])
-            max_avg_sales = max(max_avg_sales, avg_sales)
-        else:
-            avg_sales = 0
-            transactions = 0
-        
-        weekday_analysis.append({
-            'day': weekday_names[day_num],
-            'avg_sales': avg_sales,
-            'transactions': transactions
-        })
-    
-    # ===== TOP PRODUCTS =====
-    products = Product.query.filter_by(user_id=user_id).all()
-    product_sales = []
-    
-    for product in products:
-        sales = Sale.query.filter(
-            Sale.product_id == product.id,
-            Sale.user_id == user_id
-        ).all()
-        
-        if sales:
-            total_qty = float(sum(s.quantity for s in sales))
-            total_revenue = float(sum(s.total_amount for s in sales))
-            
-            product_sales.append({
-                'name': product.name,
-                'quantity': total_qty,
-                'revenue': total_revenue
-            })
-    
-    top_products = sorted(product_sales, key=lambda x: x['revenue'], reverse=True)[:5]
-    
-    # ===== LAST 7 DAYS DETAILS =====
-    last_7_days = []
-    
-    for i in range(6, -1, -1):
-        date = now - timedelta(days=i)
-        date_str = date.strftime('%Y-%m-%d')
-        
-        day_sales = Sale.query.filter(
-            func.date(Sale.date) == date_str,
-            Sale.user_id == user_id
-        ).all()
-        
-        if day_sales:
-            transactions = len(day_sales)
-            items = sum(s.quantity for s in day_sales)
-            revenue = float(sum(s.total_amount for s in day_sales))
-            
-            profit = 0
-            for sale in day_sales:
-                product = Product.query.get(sale.product_id)
-                if product:
-                    cost_price = sale.cost_at_sale if sale.cost_at_sale is not None else product.cost_price
-                    profit += float(sale.quantity) * (float(sale.selling_price) - float(cost_price))
-            
-            margin = round((profit / revenue * 100) if revenue > 0 else 0, 1)
-        else:
-            transactions = 0
-            items = 0
-            revenue = 0
-            profit = 0
-            margin = 0
-        
-        last_7_days.append({
-            'date': date.strftime('%d %b'),
-            'day_name': date.strftime('%A'),
-            'transactions': transactions,
-            'items_sold': items,
-            'revenue': revenue,
-            'profit': profit,
-            'margin': margin
-        })
-    
-    # ===== CURRENT MONTH PROFIT =====
-    current_month_profit = 0
-    for sale in monthly_sales_data:
-        product = Product.query.get(sale.product_id)
-        if product:
-            cost_price = sale.cost_at_sale if sale.cost_at_sale is not None else product.cost_price
-            current_month_profit += float(sale.quantity) * (float(sale.selling_price) - float(cost_price))
-    
-    profit_margin = round((current_month_profit / monthly_sales * 100) if monthly_sales > 0 else 0, 1)
-    
-    # ===== CATEGORY BREAKDOWN =====
-    categories = {}
-    for sale in monthly_sales_data:
-        product = Product.query.get(sale.product_id)
-        if product and product.category:
-            if product.category not in categories:
-                categories[product.category] = {
-                    'sales': 0,
-                    'revenue': 0
-                }
-            categories[product.category]['sales'] += float(sale.quantity)
-            categories[product.category]['revenue'] += float(sale.total_amount)
-    
-    category_data = []
-    max_category_revenue = 1  # Prevent division by zero
-    for cat, data in categories.items():
-        category_data.append({
-            'category': cat,
-            'sales': data['sales'],
-            'revenue': data['revenue']
-        })
-        max_category_revenue = max(max_category_revenue, data['revenue'])
-    
-    # ===== MONTHS DATA FOR TABLE =====
-    months_data = []
-    for i in range(5, -1, -1):
-        month = current_month - i
-        year = current_year
-        if month <= 0:
-            month += 12
-            year -= 1
-        
-        month_sales = Sale.query.filter(
-            extract('month', Sale.date) == month,
-            extract('year', Sale.date) == year,
-            Sale.user_id == user_id
-        ).all()
-        
-        month_total = float(sum(s.total_amount for s in month_sales) or 0)
-        
-        month_profit = 0
-        for sale in month_sales:
-            product = Product.query.get(sale.product_id)
-            if product:
-                cost_price = sale.cost_at_sale if sale.cost_at_sale is not None else product.cost_price
-                month_profit += float(sale.quantity) * (float(sale.selling_price) - float(cost_price))
-        
-        months_data.append({
-            'month': calendar.month_abbr[month],
-            'sales': month_total,
-            'profit': month_profit
-        })
-    
-    # ===== ADDITIONAL METRICS =====
-    unique_days = db.session.query(func.date(Sale.date)).distinct().filter(Sale.user_id == user_id).count()
-    
-    total_transactions = Sale.query.filter_by(user_id=user_id).count()
-    avg_transaction = (monthly_sales / total_transactions) if total_transactions > 0 else 0
-    
-    ytd_sales = Sale.query.filter(
-        extract('year', Sale.date) == current_year,
-        Sale.user_id == user_id
-    ).all()
-    ytd_total = float(sum(s.total_amount for s in ytd_sales) or 0)
-    
-    return render_template('analytics.html',
-                         # Date info
-                         now=now,
-                         today_date_formatted=today_date_formatted,
-                         
-                         # Summary cards
-                         today_sales=today_sales,
-                         monthly_sales=monthly_sales,
-                         avg_daily=avg_daily,
-                         best_day=best_day,
-                         best_day_date=best_day_date,
-                         
-                         # Additional metrics
-                         ytd_sales=ytd_total,
-                         avg_transaction=avg_transaction,
-                         unique_days=unique_days,
-                         
-                         # Charts data
-                         daily_labels=daily_labels,
-                         daily_data=daily_data,
-                         monthly_labels=monthly_labels,
-                         monthly_data=monthly_data,
-                         
-                         # Analysis tables
-                         weekday_analysis=weekday_analysis,
-                         top_products=top_products,
-                         last_7_days=last_7_days,
-                         category_data=category_data,
-                         months_data=months_data,
-                         
-                         # For template calculations
-                         max_avg_sales=max_avg_sales,
-                         max_category_revenue=max_category_revenue,
-                         
-                         # Current month details
-                         current_month=current_month_name,
-                         monthly_profit=current_month_profit,
-                         profit_margin=profit_margin)
+        values = kpis.get(user_id)
+    report = kpis.report()
+    return jsonify({
+        'kpis': values,
+        'drift': [d for d in report['drift'] if d['user_id'] == user_id]
+    })
 # ============= FIXED PREDICTION PAGE =============
 
 
@@ -674,7 +599,7 @@ def auto_correct_timestamps():
     """Automatically fixes sales/transactions that are in the future relative to now."""
     with app.app_context():
         try:
-            now = datetime.now()
+            now = periods.local_now()
             today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
             
             # 1. Fix Future Sales
@@ -718,7 +643,13 @@ def auto_correct_timestamps():
                         except:
                             pass
                             
+            if future_sales:
+                resync_sale_dates([sale.id for sale in future_sales])
             db.session.commit()
+            
+            # Shifted sales may have moved to another day
+            if future_sales:
+                rebuild_daily_rollup()
         except Exception as e:
             print(f"Auto-correction warning: {e}")
 
@@ -731,11 +662,105 @@ def optimize_db():
             db.session.execute(text('CREATE INDEX IF NOT EXISTS idx_sale_user_date ON sale (user_id, date)'))
             # "transaction" is a reserved word so quoting it is safer
             db.session.execute(text('CREATE INDEX IF NOT EXISTS idx_txn_date ON "transaction" (date)'))
+            db.session.execute(text('CREATE INDEX IF NOT EXISTS idx_txn_user_date ON "transaction" (user_id, date)'))
             db.session.commit()
             print("Database optimized with indexes.")
         except Exception as e:
             print(f"Optimization warning: {e}")
 
+def backfill_rollup():
+    """Builds the daily sales rollup for databases that predate it."""
+    with app.app_context():
+        try:
+            if ensure_daily_rollup():
+                print("Daily sales rollup rebuilt.")
+        except Exception as e:
+            print(f"Rollup warning: {e}")
+
+def backfill_stock_ledger():
+    """Builds the stock ledger for databases that predate it and takes today's snapshot."""
+    with app.app_context():
+        try:
+            if ensure_stock_ledger():
+                print("Stock ledger rebuilt from sales and stock-in history.")
+        except Exception as e:
+            print(f"Stock ledger warning: {e}")
+
+def backfill_customer_directory():
+    """Imports a pre-database customers.xlsx into the first shop's empty directory."""
+    with app.app_context():
+        try:
+            if os.path.exists(CUSTOMERS_FILE) and db.session.query(CustomerProfile.id).first() is None:
+                owner = db.session.query(db.func.min(User.id)).scalar()
+                if owner is not None:
+                    count = import_customers(owner, read_customers_file(CUSTOMERS_FILE))
+                    print(f"Imported {count} customers from customers.xlsx.")
+        except Exception as e:
+            print(f"Customer import warning: {e}")
+
+@app.cli.command('import-customers')
+@click.argument('user_id', type=int)
+@click.argument('path', required=False)
+def import_customers_command(user_id, path):
+    """Add the customers in an Excel directory (default: customers.xlsx) to a shop."""
+    path = path or CUSTOMERS_FILE
+    if not os.path.exists(path):
+        print(f"{path} not found.")
+        return
+    count = import_customers(user_id, read_customers_file(path))
+    print(f"Imported {count} customers.")
+
+@app.cli.command('rebuild-stock-ledger')
+def rebuild_stock_ledger_command():
+    """Regenerate stock_movement and stock_snapshot from sale and stock_in history."""
+    rebuild_stock_ledger()
+    print("Stock ledger rebuilt.")
+
+@app.cli.command('audit-stock')
+def audit_stock_command():
+    """List products whose current_stock disagrees with the ledger."""
+    mismatches = reconcile_current_stock()
+    for product_id, name, stored, ledger in mismatches:
+        print(f"{product_id:>5} {name}: stored {stored:g}, ledger {ledger:g}")
+    print(f"{len(mismatches)} product(s) out of step with the ledger.")
+
+@app.cli.command('import-barcodes')
+@click.argument('user_id', type=int)
+@click.argument('csv_file', type=click.File('rb'))
+def import_barcodes_command(user_id, csv_file):
+    """Label USER_ID's products from a CSV of product id or name, barcode."""
+    labelled, errors = import_barcodes(user_id, read_barcode_csv(csv_file))
+    for error in errors:
+        print(error)
+    print(f"{labelled} product(s) labelled.")
+
+@app.cli.command('bench-scan')
+@click.argument('user_id', type=int)
+@click.option('--scans', default=5000, help='Number of scans to replay.')
+def bench_scan_command(user_id, scans):
+    """Replay random barcode scans through /api/products/barcode and report the rate."""
+    codes = list(catalog.get(user_id).by_barcode)
+    if not codes:
+        print("No labelled products; run import-barcodes first.")
+        return
+    client = app.test_client()
+    with client.session_transaction() as s:
+        s['user_id'] = user_id
+    picks = [random.choice(codes) for _ in range(scans)]
+    started = time.perf_counter()
+    for code in picks:
+        if client.get(f'/api/products/barcode/{code}').status_code != 200:
+            print(f"Lookup failed for {code}")
+            return
+    elapsed = time.perf_counter() - started
+    print(f"{scans} scans in {elapsed:.2f}s: {scans / elapsed:,.0f} scans/s, {elapsed / scans * 1000:.2f} ms each")
+
+@app.cli.command('rebuild-rollup')
+def rebuild_rollup_command():
+    """Recompute the daily_product_rollup table from the sale table."""
+    rebuild_daily_rollup()
+    print("Daily sales rollup rebuilt.")
+
 if __name__ == "__main__":
     import traceback
     try:
@@ -772,7 +797,11 @@ if __name__ == "__main__":
                                 current_db_path = 'instance/shop.db' # Fallback
                                 
                             # Run generator in separate thread to not block startup
-                            threading.Thread(target=lambda: DailySalesGenerator(db_path=current_db_path).run()).start()
+                            def generate():
+                                DailySalesGenerator(db_path=current_db_path).run()
+                                # Written over a raw sqlite connection, so no ORM event saw it
+                                invalidate_all()
+                            threading.Thread(target=generate).start()
                     except Exception as e:
                         print(f"Data check error: {e}")
 
@@ -783,6 +812,9 @@ if __name__ == "__main__":
             print(f"Auto-gen setup error: {e}")
 
         auto_correct_timestamps()
+        backfill_rollup()
+        backfill_stock_ledger()
+        backfill_customer_directory()
         
         # Explicitly print startup message
         print("Starting Flask server...")
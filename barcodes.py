@@ -0,0 +1,103 @@
+"""Barcode / SKU lookup for scanner-driven billing.
+
+Codes are unique per shop (idx_product_user_barcode). A scan is answered
+from the catalog's barcode map (catalog.py) without touching the database;
+only a code the cached catalog does not know costs one probe of the unique
+index, which also picks up products labelled by another worker.
+"""
+import csv
+import io
+
+from sqlalchemy import bindparam, update
+from sqlalchemy.exc import IntegrityError
+
+from models import db, Product
+from catalog import catalog, mark_changed
+
+
+def normalize(code):
+    # Scanners send the code followed by Enter; hand-typed SKUs may carry spaces
+    return (code or '').strip()
+
+
+def lookup(user_id, code):
+    """The ProductRecord labelled `code` in this shop, or None."""
+    code = normalize(code)
+    if not code:
+        return None
+    record = catalog.get(user_id).by_barcode.get(code)
+    if record is not None:
+        return record
+    row = db.session.query(Product.id).filter_by(user_id=user_id, barcode=code).first()
+    if row is None:
+        return None
+    catalog.forget(user_id)  # the cached catalog is behind the database
+    return catalog.product(user_id, row.id)
+
+
+def read_barcode_csv(stream):
+    """(product, barcode) rows from a CSV upload; a header row is skipped."""
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    rows = [row for row in csv.reader(text) if any(cell.strip() for cell in row)]
+    if rows and rows[0][-1].strip().lower() in ('barcode', 'sku'):
+        rows = rows[1:]
+    return [(row[0].strip(), normalize(row[1]) if len(row) > 1 else '') for row in rows]
+
+
+def import_barcodes(user_id, rows):
+    """Label products from (product id or exact name, barcode) rows. Commits.
+
+    All or nothing: returns (labelled count, []) on success, or
+    (0, [error messages]) without writing anything.
+    """
+    current = catalog.get(user_id)
+    by_name = {}
+    for record in current.records:
+        by_name.setdefault((record.name or '').strip().lower(), []).append(record)
+
+    errors = []
+    assignments = {}  # product id -> code
+    claimed = {}      # code -> product id
+    for line, (product, code) in enumerate(rows, start=1):
+        if product.isdigit() and int(product) in current.by_id:
+            record = current.by_id[int(product)]
+        else:
+            matches = by_name.get(product.lower(), [])
+            if len(matches) != 1:
+                errors.append(f"Line {line}: {'no' if not matches else 'more than one'} product named '{product}'")
+                continue
+            record = matches[0]
+        if not code:
+            errors.append(f"Line {line}: missing barcode for '{record.name}'")
+        elif len(code) > 64:
+            errors.append(f"Line {line}: barcode longer than 64 characters")
+        elif claimed.get(code, record.id) != record.id:
+            errors.append(f"Line {line}: barcode {code} is listed for two products")
+        else:
+            claimed[code] = record.id
+            assignments[record.id] = code
+
+    # Codes may move between products in this file, but not off products it leaves alone
+    for code, product_id in claimed.items():
+        holder = current.by_barcode.get(code)
+        if holder is not None and holder.id != product_id and holder.id not in assignments:
+            errors.append(f"Barcode {code} already belongs to '{holder.name}'")
+    if errors:
+        return 0, errors
+
+    table = Product.__table__
+    try:
+        # Clear first so codes swapped between products never collide mid-update
+        db.session.execute(
+            update(table).where(table.c.user_id == user_id, table.c.id.in_(assignments)).values(barcode=None)
+        )
+        db.session.execute(
+            update(table).where(table.c.id == bindparam('pid')).values(barcode=bindparam('code')),
+            [{'pid': pid, 'code': code} for pid, code in assignments.items()]
+        )
+        mark_changed(db.session, user_id)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return 0, ['A barcode in the file was assigned elsewhere meanwhile; nothing was imported.']
+    return len(assignments), []
@@ -1,8 +1,10 @@
 from flask import Blueprint, render_template, session, redirect
-from models import db, Product, Sale
-from sqlalchemy import extract
-from datetime import datetime, timedelta
+from models import db, DailyProductRollup
+from cache import cached
+from catalog import catalog
+from stock import watchlist
 import numpy as np
+import periods
 
 prediction_bp = Blueprint('prediction', __name__)
 
@@ -12,32 +14,36 @@ def index():
         return redirect('/login')
     
     user_id = session['user_id']
-    products = Product.query.filter_by(user_id=user_id).all()
+    # Forecasts only change when sales or stock do, which bumps the cache version
+    predictions = cached('prediction', user_id, lambda: forecast(user_id), periods.local_now().date())
+    
+    return render_template('prediction.html', predictions=predictions, watchlist=watchlist(user_id))
+
+def forecast(user_id):
+    """7 and 30 day demand forecast and reorder status for every product, most urgent first."""
+    products = catalog.products(user_id)
     
     predictions = []
     total_predicted_sales = 0
     total_recommended_stock = 0
     total_current_stock = 0
     
-    # Get last 90 days sales for trend analysis
-    ninety_days_ago = datetime.now() - timedelta(days=90)
+    # Get last 90 days sales for trend analysis (one rollup row per product per day)
+    rollup_rows = db.session.query(
+        DailyProductRollup.product_id,
+        DailyProductRollup.qty
+    ).filter(
+        DailyProductRollup.user_id == user_id,
+        periods.last_n_days(90).where_day(DailyProductRollup.day)
+    ).order_by(DailyProductRollup.day).all()
+    
+    # Group daily quantities by product, oldest day first
+    daily_sales_by_product = {}
+    for product_id, qty in rollup_rows:
+        daily_sales_by_product.setdefault(product_id, []).append(qty)
     
     for product in products:
-        # Get last 90 days sales
-        sales_90d = Sale.query.filter(
-            Sale.product_id == product.id,
-            Sale.date >= ninety_days_ago
-        ).order_by(Sale.date).all()
-        
-        # Group sales by day
-        daily_sales = {}
-        for sale in sales_90d:
-            date_str = sale.date.strftime('%Y-%m-%d')
-            if date_str not in daily_sales:
-                daily_sales[date_str] = 0
-            daily_sales[date_str] += sale.quantity
-            
-        sales_values = list(daily_sales.values())
+        sales_values = daily_sales_by_product.get(product.id, [])
         
         # Calculate Average Daily Sales (last 30 days weighted more)
         if sales_values:
@@ -105,5 +111,4 @@ def index():
         return score
 
     predictions.sort(key=sort_priority, reverse=True)
-    
-    return render_template('prediction.html', predictions=predictions)
+    return predictions
@@ -1,7 +1,8 @@
 from flask import Blueprint, render_template, redirect, session, url_for
 from models import db, Transaction
-from datetime import datetime, timedelta
+from datetime import timedelta
 import json
+import periods
 
 transactions_bp = Blueprint('transactions', __name__)
 
@@ -14,10 +15,9 @@ def index():
     user_id = session['user_id']
 
     # Get transactions from last 7 days
-    week_ago = datetime.now() - timedelta(days=7)
     transactions = Transaction.query.filter(
         Transaction.user_id == user_id,
-        Transaction.date >= week_ago
+        periods.trailing(timedelta(days=7)).where(Transaction.date)
     ).order_by(Transaction.date.desc()).all()
 
     # Summary stats
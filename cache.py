@@ -0,0 +1,154 @@
+"""Per-user result cache for computed pages (dashboard, analytics).
+
+Entries are keyed by the user's data version, which is bumped after every
+commit that wrote Sale, Product, StockIn or Transaction rows for that user.
+A bump makes every older entry unreachable, so pages only recompute after
+a write; TTL and LRU bound memory and cover writes this process cannot see
+(other gunicorn workers, the demo data generator's raw sqlite connection).
+"""
+from collections import OrderedDict
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models import Product, StockIn, Sale, Transaction, CustomerProfile
+from events import bus
+from kpi import kpis
+from topk import top_products
+from catalog import catalog
+
+VERSIONED_MODELS = (Sale, Product, StockIn, Transaction, CustomerProfile)
+
+
+class DataVersions:
+    """Monotonic per-user counters of committed writes."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._epoch = 0
+
+    def get(self, user_id):
+        with self._lock:
+            return (self._epoch, self._versions.get(user_id, 0))
+
+    def bump(self, user_id):
+        with self._lock:
+            self._versions[user_id] = self._versions.get(user_id, 0) + 1
+
+    def bump_all(self):
+        """Invalidate every user at once (e.g. after an out-of-band bulk load)."""
+        with self._lock:
+            self._epoch += 1
+
+
+class ResultCache:
+    """Thread-safe LRU cache with per-entry TTL and hit/miss counters."""
+
+    def __init__(self, maxsize=256, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+data_versions = DataVersions()
+result_cache = ResultCache()
+
+# Striped locks so concurrent misses on one key (e.g. every open dashboard
+# stream waking on the same sale) compute it once instead of once per caller.
+_compute_locks = [threading.Lock() for _ in range(32)]
+
+
+def cached(kind, user_id, compute, *key_parts):
+    """Return compute() for (kind, user_id, *key_parts) at the user's current data version."""
+    key = (kind, user_id, data_versions.get(user_id)) + key_parts
+    value = result_cache.get(key)
+    if value is None:
+        with _compute_locks[hash(key) % len(_compute_locks)]:
+            value = result_cache.get(key)
+            if value is None:
+                value = compute()
+                result_cache.put(key, value)
+    return value
+
+
+def invalidate_all():
+    """Drop every user's cached results, KPIs, rankings and catalogs and tell live streams to refresh."""
+    data_versions.bump_all()
+    kpis.forget()
+    top_products.forget()
+    catalog.forget()
+    bus.publish_all('changed')
+
+
+# ===== WRITE TRACKING =====
+# Collect touched user ids at flush time and only bump once the transaction
+# commits: bumping earlier would let a concurrent reader cache pre-commit data
+# under the new version.
+def mark_written(session, user_id):
+    """Bump `user_id` when `session` commits (for Core writes the ORM does not track)."""
+    if user_id is not None:
+        session.info.setdefault('written_user_ids', set()).add(int(user_id))
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_written_users(session, flush_context):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, VERSIONED_MODELS):
+            mark_written(session, obj.user_id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _bump_written_users(session):
+    for user_id in session.info.pop('written_user_ids', ()):
+        data_versions.bump(user_id)
+        bus.publish(user_id, 'changed')
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_written_users(session):
+    session.info.pop('written_user_ids', None)
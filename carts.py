@@ -0,0 +1,120 @@
+"""Server-side carts for the billing counter.
+
+The cart used to travel in Flask's signed cookie as `current_order`, so
+every request carried and re-verified the whole bill. Now the cookie
+holds a short random cart id; lines live in open_cart_line and change one
+at a time through the cart API, and the priced bill shown at payment is
+kept on the open_cart row. Carts untouched for TTL are dropped whenever a
+new one is opened. Every function here commits.
+"""
+from datetime import timedelta
+import json
+import secrets
+
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from models import db, OpenCart, OpenCartLine
+import periods
+
+TTL = timedelta(hours=12)
+
+
+def open_cart(user_id, customer_name, customer_phone):
+    """Start an empty cart; returns its id."""
+    purge_expired()
+    cart = OpenCart(
+        id=secrets.token_urlsafe(12),
+        user_id=user_id,
+        customer_name=customer_name,
+        customer_phone=customer_phone,
+        updated_at=periods.local_now()
+    )
+    db.session.add(cart)
+    db.session.commit()
+    return cart.id
+
+
+def get_cart(user_id, cart_id):
+    """`user_id`'s cart `cart_id`, or None if it is unknown or expired."""
+    if not cart_id:
+        return None
+    cart = db.session.get(OpenCart, cart_id)
+    if cart is None or cart.user_id != user_id or cart.updated_at < periods.local_now() - TTL:
+        return None
+    return cart
+
+
+def cart_lines(cart):
+    """{product_id: qty} in the order the lines were added."""
+    rows = db.session.query(OpenCartLine.product_id, OpenCartLine.qty).filter(
+        OpenCartLine.cart_id == cart.id
+    ).order_by(db.text('open_cart_line.rowid'))
+    return {row.product_id: row.qty for row in rows}
+
+
+def set_line(cart, product_id, qty=None, add=None):
+    """Set a line to `qty`, or change it by `add`; a line at or below zero is removed.
+
+    Returns the line's new quantity.
+    """
+    table = OpenCartLine.__table__
+    if add is not None:
+        current = db.session.query(OpenCartLine.qty).filter_by(cart_id=cart.id, product_id=product_id).scalar()
+        qty = (current or 0) + add
+    if qty > 0:
+        stmt = sqlite_insert(table).values(cart_id=cart.id, product_id=product_id, qty=qty)
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=['cart_id', 'product_id'],
+            set_={'qty': stmt.excluded.qty}
+        ))
+    else:
+        qty = 0
+        db.session.execute(table.delete().where(table.c.cart_id == cart.id, table.c.product_id == product_id))
+    cart.order_data = None  # the bill no longer matches the lines
+    _touch(cart)
+    db.session.commit()
+    return qty
+
+
+def replace_lines(cart, quantities):
+    """Make {product_id: qty} the cart's whole contents."""
+    table = OpenCartLine.__table__
+    db.session.execute(table.delete().where(table.c.cart_id == cart.id))
+    if quantities:
+        db.session.execute(table.insert(), [
+            {'cart_id': cart.id, 'product_id': pid, 'qty': qty} for pid, qty in quantities.items()
+        ])
+    cart.order_data = None
+    _touch(cart)
+    db.session.commit()
+
+
+def get_order(cart):
+    return json.loads(cart.order_data) if cart is not None and cart.order_data else None
+
+
+def set_order(cart, order):
+    """Keep the priced bill (items, total, customer) the payment page shows."""
+    cart.order_data = json.dumps(order)
+    _touch(cart)
+    db.session.commit()
+
+
+def close_cart(cart):
+    """Drop a cart once it has been sold."""
+    db.session.execute(OpenCartLine.__table__.delete().where(OpenCartLine.__table__.c.cart_id == cart.id))
+    db.session.delete(cart)
+    db.session.commit()
+
+
+def purge_expired():
+    cutoff = periods.local_now() - TTL
+    lines, carts = OpenCartLine.__table__, OpenCart.__table__
+    expired = select(carts.c.id).where(carts.c.updated_at < cutoff)
+    db.session.execute(lines.delete().where(lines.c.cart_id.in_(expired)))
+    db.session.execute(carts.delete().where(carts.c.updated_at < cutoff))
+
+
+def _touch(cart):
+    cart.updated_at = periods.local_now()
@@ -0,0 +1,83 @@
+"""In-process event bus feeding the live dashboard stream.
+
+cache.py publishes a "changed" notice for a user after every commit that
+touched their sales or stock. Each open /dashboard/stream holds a small
+queue here and blocks on it, so idle tabs do no database work at all.
+
+The bus is per process: under gunicorn every worker has its own, which is
+why streams are capped in length (see STREAM_MAX_AGE in app.py) and the
+browser's automatic reconnect picks up writes made in other workers.
+"""
+import json
+import queue
+import threading
+
+
+class EventBus:
+    """Fan-out of per-user notifications to subscriber queues."""
+
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._subscribers = {}
+
+    def subscribe(self, user_id):
+        q = queue.Queue(maxsize=self.maxsize)
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(q)
+        return q
+
+    def unsubscribe(self, user_id, q):
+        with self._lock:
+            subscribers = self._subscribers.get(user_id)
+            if subscribers is not None:
+                subscribers.discard(q)
+                if not subscribers:
+                    del self._subscribers[user_id]
+
+    def publish(self, user_id, event):
+        with self._lock:
+            targets = list(self._subscribers.get(user_id, ()))
+        for q in targets:
+            _offer(q, event)
+
+    def publish_all(self, event):
+        with self._lock:
+            targets = [q for subscribers in self._subscribers.values() for q in subscribers]
+        for q in targets:
+            _offer(q, event)
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+
+def _offer(q, event):
+    # A stalled subscriber only ever needs the latest notice: drop the oldest
+    # instead of blocking the committing request.
+    while True:
+        try:
+            q.put_nowait(event)
+            return
+        except queue.Full:
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                pass
+
+
+def format_sse(data=None, event=None, retry=None, comment=None):
+    """Encode one Server-Sent Events message."""
+    lines = []
+    if comment is not None:
+        lines.append(f': {comment}')
+    if retry is not None:
+        lines.append(f'retry: {retry}')
+    if event is not None:
+        lines.append(f'event: {event}')
+    if data is not None:
+        lines.extend(f'data: {line}' for line in json.dumps(data).splitlines())
+    return '\n'.join(lines) + '\n\n'
+
+
+bus = EventBus()
@@ -13,6 +13,8 @@ import pandas as pd
 import calendar
 from collections import defaultdict
 import json
+from profit import profit_select, compile_for_sqlite
+from ledger import stock_levels_select, snapshot_insert
 
 class DailySalesGenerator:
     def __init__(self, db_path='instance/shop.db'):
@@ -277,6 +279,9 @@ class DailySalesGenerator:
                 INSERT INTO sale (id, product_id, quantity, selling_price, cost_at_sale, total_amount, date, user_id)
                 VALUES (?, ?, ?, ?, ?, ?, ?, ?)
             ''', batch)
+            self.update_daily_rollup(batch)
+            self.record_stock_movements('sale', [(sale_id, product_id, -quantity, date_str, user_id)
+                                                 for sale_id, product_id, quantity, _, _, _, date_str, user_id in batch])
             self.conn.commit()
             print(f"   Inserted Sale batch {i//batch_size + 1}/{(len(daily_sales_data)//batch_size)+1}")
         
@@ -356,6 +361,41 @@ class DailySalesGenerator:
         print(f"\nGenerated {len(daily_sales_data)} daily sales records")
         return daily_sales_data
     
+    def update_daily_rollup(self, sales_batch):
+        """Fold a batch of sale tuples into daily_product_rollup (caller commits)"""
+        buckets = defaultdict(lambda: [0, 0, 0, 0])
+        for _, product_id, quantity, _, cost, total, date_str, user_id in sales_batch:
+            bucket = buckets[(user_id, date_str[:10], product_id)]
+            bucket[0] += quantity
+            bucket[1] += total
+            bucket[2] += quantity * cost
+            bucket[3] += 1
+
+        self.cursor.executemany('''
+            INSERT INTO daily_product_rollup (user_id, day, product_id, qty, revenue, cost, txn_count)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (user_id, day, product_id) DO UPDATE SET
+                qty = qty + excluded.qty,
+                revenue = revenue + excluded.revenue,
+                cost = cost + excluded.cost,
+                txn_count = txn_count + excluded.txn_count
+        ''', [key + tuple(values) for key, values in buckets.items()])
+    
+    def record_stock_movements(self, kind, rows):
+        """Append (ref_id, product_id, delta, date, user_id) rows to the stock ledger (caller commits)"""
+        if not rows:
+            return
+        self.cursor.executemany('''
+            INSERT INTO stock_movement (ref_id, product_id, delta, kind, date, user_id)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', [(ref_id, product_id, delta, kind, date, user_id) for ref_id, product_id, delta, date, user_id in rows])
+
+        # Backdated rows change every snapshot taken after them
+        self.cursor.execute('''
+            DELETE FROM stock_snapshot
+            WHERE day > ? AND product_id IN (SELECT id FROM product WHERE user_id = ?)
+        ''', (min(row[3] for row in rows)[:10], self.user_id))
+
     def generate_stock_in(self):
         """Generate stock in records, appending new if needed"""
         
@@ -427,33 +467,23 @@ class DailySalesGenerator:
                 INSERT INTO stock_in (id, product_id, quantity, cost_price, date, user_id)
                 VALUES (?, ?, ?, ?, ?, ?)
             ''', stock_data)
+            self.record_stock_movements('stock_in', [(stock_id, product_id, quantity, date, user_id)
+                                                     for stock_id, product_id, quantity, _, date, user_id in stock_data])
             self.conn.commit()
             print(f"Generated {len(stock_data)} stock in records")
         
         return stock_data
     
     def update_stock_levels(self):
-        """Update current stock based on sales"""
-        for product in self.products:
-            product_id = product[0]
-            
-            # Total sold
-            self.cursor.execute('''
-                SELECT SUM(quantity) FROM sale WHERE product_id = ?
-            ''', (product_id,))
-            sold = self.cursor.fetchone()[0] or 0
-            
-            # Total received
-            self.cursor.execute('''
-                SELECT SUM(quantity) FROM stock_in WHERE product_id = ?
-            ''', (product_id,))
-            received = self.cursor.fetchone()[0] or 0
-            
-            current = received - sold
-            self.cursor.execute('''
-                UPDATE product SET current_stock = ? WHERE id = ?
-            ''', (current, product_id))
-        
+        """Update current stock from the stock ledger (latest snapshot + movements since)"""
+        self.cursor.execute(compile_for_sqlite(stock_levels_select(user_id=self.user_id)))
+        levels = self.cursor.fetchall()
+        self.cursor.executemany('''
+            UPDATE product SET current_stock = ? WHERE id = ?
+        ''', [(quantity, product_id) for product_id, quantity in levels])
+
+        # Snapshot as of today so the next lookup only reads today's movements
+        self.cursor.execute(compile_for_sqlite(snapshot_insert(datetime.now().date(), self.user_id)))
         self.conn.commit()
         print("Stock levels updated")
     
@@ -477,21 +507,11 @@ class DailySalesGenerator:
         df = pd.DataFrame(daily_summary, 
                          columns=['Date', 'Transactions', 'Items_Sold', 'Revenue', 'Avg_Transaction'])
         
-        # Add profit calculation
-        profits = []
-        for date in df['Date']:
-            self.cursor.execute('''
-                SELECT s.quantity, p.selling_price, p.cost_price
-                FROM sale s
-                JOIN product p ON s.product_id = p.id
-                WHERE DATE(s.date) = ? AND s.user_id = ?
-            ''', (date, self.user_id))
-            
-            day_sales = self.cursor.fetchall()
-            day_profit = sum(q * (sp - cp) for q, sp, cp in day_sales)
-            profits.append(day_profit)
+        # Add profit calculation (one grouped query, same cost basis as the app)
+        self.cursor.execute(compile_for_sqlite(profit_select(self.user_id, by='day')))
+        profit_by_day = {row[0]: row[3] for row in self.cursor.fetchall()}
         
-        df['Profit'] = profits
+        df['Profit'] = [profit_by_day.get(date, 0) for date in df['Date']]
         df['Profit_Margin'] = (df['Profit'] / df['Revenue'] * 100).round(1)
         
         # Save to CSV
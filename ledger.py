@@ -0,0 +1,234 @@
+"""Stock movement ledger with per-product daily snapshots.
+
+Every change to Product.current_stock is also appended to stock_movement
+(sales, stock-ins, reorders, manual adjustments), so stock can be audited
+and rebuilt. stock_snapshot stores each product's level at the start of a
+day; the level at any moment is the latest snapshot at or before it plus
+the short tail of movements since, an index range scan on
+idx_movement_product_date instead of a pass over the whole history.
+
+Snapshots only ever cover whole past days, so movements stamped "now"
+never invalidate them. Startup snapshots the current day, and the first
+stock write of each later day snapshots that day's opening levels in the
+same transaction, so a long-running server replays at most a day's
+tail. Backdated writes (the demo data generator, timestamp corrections)
+must call invalidate_snapshots() for the days they touched. None of the
+functions here commit unless they say so.
+"""
+from datetime import datetime, time
+
+from sqlalchemy import and_, event, func, insert, literal, select, String
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from models import db, Product, Sale, StockIn, StockMovement, StockSnapshot
+import periods
+
+KINDS = ('sale', 'stock_in', 'reorder', 'adjustment', 'opening')
+
+# Latest local day this process has committed a snapshot for
+_snapshot_day = None
+
+
+def record_movement(product_id, delta, kind, ref_id=None, note=None, date=None):
+    """Append one movement; the owner is taken from the product row."""
+    if kind not in KINDS:
+        raise ValueError(f'unknown stock movement kind {kind!r}')
+    when = date or periods.local_now()
+    db.session.execute(insert(StockMovement).values(
+        product_id=product_id,
+        delta=delta,
+        kind=kind,
+        ref_id=ref_id,
+        note=note,
+        date=when,
+        user_id=select(Product.user_id).where(Product.id == product_id).scalar_subquery()
+    ))
+    snapshot_new_day()
+    if when.date() < periods.local_now().date():
+        invalidate_snapshots(when, [product_id])
+
+
+def record_movements(movements):
+    """Append many movements dated now in one executemany; dicts carry their user_id."""
+    for movement in movements:
+        if movement['kind'] not in KINDS:
+            raise ValueError(f"unknown stock movement kind {movement['kind']!r}")
+    if movements:
+        db.session.execute(insert(StockMovement), movements)
+        snapshot_new_day()
+
+
+def invalidate_snapshots(since, product_ids=None):
+    """Drop snapshots that a movement dated `since` would have changed."""
+    day = since.date() if isinstance(since, datetime) else since
+    stmt = StockSnapshot.__table__.delete().where(StockSnapshot.day > day)
+    if product_ids is not None:
+        stmt = stmt.where(StockSnapshot.product_id.in_(product_ids))
+    db.session.execute(stmt)
+
+
+def resync_sale_dates(sale_ids):
+    """Copy corrected Sale.date values onto their ledger rows (after timestamp fixes)."""
+    if not sale_ids:
+        return
+    M = StockMovement
+    db.session.execute(
+        M.__table__.update()
+        .where(M.kind == 'sale', M.ref_id.in_(sale_ids))
+        .values(date=select(Sale.date).where(Sale.id == M.ref_id).scalar_subquery())
+    )
+    earliest = db.session.query(func.min(Sale.date)).filter(Sale.id.in_(sale_ids)).scalar()
+    if earliest is not None:
+        invalidate_snapshots(earliest)
+
+
+def stock_levels_select(as_of=None, product_ids=None, user_id=None):
+    """Core SELECT of (product_id, quantity) at `as_of` (None = now, all movements).
+
+    quantity = latest snapshot taken at or before as_of + movements since it.
+    """
+    M, S = StockMovement, StockSnapshot
+
+    latest = select(S.product_id, func.max(S.day).label('day'))
+    if product_ids is not None:
+        latest = latest.where(S.product_id.in_(product_ids))
+    if as_of is not None:
+        latest = latest.where(S.day <= (as_of.date() if isinstance(as_of, datetime) else as_of))
+    latest = latest.group_by(S.product_id).subquery('latest')
+
+    # Date compares as text: '2024-05-01 09:30:00' >= '2024-05-01'
+    tail = select(func.coalesce(func.sum(M.delta), 0)).where(
+        M.product_id == Product.id,
+        M.date >= func.coalesce(func.cast(latest.c.day, String), literal(''))
+    )
+    if as_of is not None:
+        tail = tail.where(M.date < periods.as_stored(as_of))
+
+    stmt = select(
+        Product.id.label('product_id'),
+        (func.coalesce(S.quantity, 0) + tail.scalar_subquery()).label('quantity')
+    ).outerjoin(latest, latest.c.product_id == Product.id).outerjoin(
+        S, and_(S.product_id == latest.c.product_id, S.day == latest.c.day)
+    )
+    if product_ids is not None:
+        stmt = stmt.where(Product.id.in_(product_ids))
+    if user_id is not None:
+        stmt = stmt.where(Product.user_id == user_id)
+    return stmt
+
+
+def stock_levels(as_of=None, product_ids=None, user_id=None):
+    """{product_id: quantity} from the ledger at `as_of` (None = now)."""
+    return {r.product_id: float(r.quantity) for r in db.session.execute(stock_levels_select(as_of, product_ids, user_id))}
+
+
+def stock_as_of(product_id, as_of=None):
+    return stock_levels(as_of, [product_id]).get(product_id, 0.0)
+
+
+def snapshot_insert(day, user_id=None):
+    """INSERT of each product's level at the start of `day`, skipping existing snapshots."""
+    levels = stock_levels_select(datetime.combine(day, time()), user_id=user_id).subquery()
+    # The WHERE keeps SQLite from reading ON CONFLICT as a join constraint
+    source = select(levels.c.product_id, literal(day), levels.c.quantity).where(levels.c.product_id.isnot(None))
+    return sqlite_insert(StockSnapshot).from_select(['product_id', 'day', 'quantity'], source).on_conflict_do_nothing()
+
+
+def take_snapshots(day=None, user_id=None):
+    """Snapshot every product as of the start of `day` (default: today). Commits."""
+    today = periods.local_now().date()
+    day = day or today
+    db.session.execute(snapshot_insert(day, user_id))
+    if day == today and user_id is None:
+        db.session.info['snapshot_day'] = day
+    db.session.commit()
+
+
+def snapshot_new_day():
+    """On the first stock write of a new local day, snapshot every product as of its start.
+
+    Runs in the caller's transaction, which already holds SQLite's write
+    lock; the day only counts as done once that transaction commits.
+    """
+    today = periods.local_now().date()
+    if _snapshot_day == today or db.session.info.get('snapshot_day') == today:
+        return
+    db.session.execute(snapshot_insert(today))
+    db.session.info['snapshot_day'] = today
+
+
+@event.listens_for(Session, 'after_commit')
+def _note_snapshot_day(session):
+    global _snapshot_day
+    day = session.info.pop('snapshot_day', None)
+    if day is not None and (_snapshot_day is None or day > _snapshot_day):
+        _snapshot_day = day
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_snapshot_day(session):
+    session.info.pop('snapshot_day', None)
+
+
+def reconcile_current_stock(user_id=None):
+    """Products whose current_stock disagrees with the ledger: [(id, name, stored, ledger)]."""
+    ledger = stock_levels(user_id=user_id)
+    query = Product.query if user_id is None else Product.query.filter_by(user_id=user_id)
+    return [
+        (p.id, p.name, float(p.current_stock or 0), ledger.get(p.id, 0.0))
+        for p in query
+        if abs(float(p.current_stock or 0) - ledger.get(p.id, 0.0)) > 1e-6
+    ]
+
+
+def rebuild_stock_ledger():
+    """Regenerate the ledger from sale and stock_in history. Commits.
+
+    An 'opening' movement per product, dated before its first recorded
+    movement, carries whatever current_stock is not explained by history
+    (initial stock, edits made before the ledger existed), so the ledger
+    total always equals current_stock afterwards.
+    """
+    db.session.execute(StockSnapshot.__table__.delete())
+    db.session.execute(StockMovement.__table__.delete())
+
+    table = StockMovement.__table__
+    columns = ['product_id', 'delta', 'kind', 'ref_id', 'date', 'user_id']
+    db.session.execute(table.insert().from_select(columns, select(
+        Sale.product_id, -Sale.quantity, literal('sale'), Sale.id, Sale.date, Sale.user_id
+    ).where(Sale.product_id.isnot(None), Sale.quantity.isnot(None))))
+    db.session.execute(table.insert().from_select(columns, select(
+        StockIn.product_id, StockIn.quantity, literal('stock_in'), StockIn.id, StockIn.date, StockIn.user_id
+    ).where(StockIn.product_id.isnot(None), StockIn.quantity.isnot(None))))
+
+    history = dict(db.session.query(StockMovement.product_id, func.sum(StockMovement.delta)).group_by(StockMovement.product_id))
+    first = dict(db.session.query(StockMovement.product_id, func.min(StockMovement.date)).group_by(StockMovement.product_id))
+    openings = []
+    for product in Product.query:
+        missing = float(product.current_stock or 0) - float(history.get(product.id) or 0)
+        if abs(missing) > 1e-9:
+            start = first.get(product.id) or periods.local_now()
+            openings.append({
+                'product_id': product.id,
+                'delta': missing,
+                'kind': 'opening',
+                'note': 'Balance before ledger',
+                'date': datetime.combine(start.date(), time()),
+                'user_id': product.user_id,
+            })
+    if openings:
+        db.session.execute(insert(StockMovement), openings)
+
+    take_snapshots()
+
+
+def ensure_stock_ledger():
+    """Backfill the ledger for databases created before it existed, then snapshot today."""
+    has_products = db.session.query(Product.id).first() is not None
+    has_ledger = db.session.query(StockMovement.id).first() is not None
+    if has_products and not has_ledger:
+        rebuild_stock_ledger()
+        return True
+    take_snapshots()
+    return False
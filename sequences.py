@@ -0,0 +1,71 @@
+"""Invoice and receipt numbers.
+
+Numbers come from sequence_counter, one row per shop and sequence. A
+worker process reserves BLOCK_SIZE numbers at a time with one upsert on
+its own short transaction, then hands them out from memory: numbers are
+unique across workers and threads, increase within each worker, and cost
+one statement per block rather than per invoice. Numbers left in a
+block when a worker exits are skipped, never reused.
+
+The reservation commits on a separate connection, so take() must be
+called before the caller's session writes anything: SQLite allows one
+writer, and a session already holding the lock would block it.
+"""
+import threading
+
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from models import db, SequenceCounter
+
+BLOCK_SIZE = 20
+FORMATS = {
+    'invoice': '{:06d}',
+    'khata_receipt': 'KP{:06d}',
+}
+
+
+def reserve(user_id, name, count):
+    """Claim `count` numbers in their own transaction; returns the first."""
+    stmt = sqlite_insert(SequenceCounter.__table__).values(user_id=user_id, name=name, next_value=1 + count)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['user_id', 'name'],
+        set_={'next_value': SequenceCounter.__table__.c.next_value + count}
+    ).returning(SequenceCounter.__table__.c.next_value)
+    with db.engine.begin() as conn:
+        return conn.execute(stmt).scalar_one() - count
+
+
+class SequenceAllocator:
+    """Thread-safe map of (user_id, sequence) -> the rest of this worker's block."""
+
+    def __init__(self, block_size=BLOCK_SIZE):
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._blocks = {}  # (user_id, name) -> [next, end)
+        self.reservations = 0
+
+    def take(self, user_id, name, count=1):
+        """`count` formatted numbers of `user_id`'s `name` sequence, in order."""
+        key = (int(user_id), name)
+        numbers = []
+        with self._lock:
+            block = self._blocks.get(key)
+            while len(numbers) < count:
+                if block is None or block[0] >= block[1]:
+                    size = max(self.block_size, count - len(numbers))
+                    start = reserve(key[0], name, size)
+                    block = self._blocks[key] = [start, start + size]
+                    self.reservations += 1
+                numbers.append(block[0])
+                block[0] += 1
+        return [FORMATS.get(name, '{}').format(n) for n in numbers]
+
+    def next(self, user_id, name):
+        return self.take(user_id, name)[0]
+
+    def forget(self):
+        with self._lock:
+            self._blocks.clear()
+
+
+sequences = SequenceAllocator()
@@ -1,62 +1,149 @@
-from flask import Blueprint, render_template, request, redirect, url_for, session
-from models import db, Product, Sale
+from flask import Blueprint, render_template, request, redirect, url_for, session, flash, jsonify
+from models import db, Sale
+from catalog import catalog
+from search import search_products
+from checkout import price_cart
+from barcodes import lookup as lookup_barcode
+from carts import open_cart, get_cart, cart_lines, set_line, replace_lines, set_order
 from datetime import datetime
+import math
 
 billing_bp = Blueprint('billing', __name__)
 
+
+def current_cart():
+    """The signed-in user's open cart from the session's cart id, or None."""
+    if 'user_id' not in session:
+        return None
+    return get_cart(session['user_id'], session.get('cart_id'))
+
+
+def cart_summary(cart):
+    """The cart priced from the cached catalog, for the cart API."""
+    quantities = cart_lines(cart)
+    items, total_amount, problems = price_cart(quantities, catalog.get(cart.user_id).by_id)
+    return {
+        'cart_id': cart.id,
+        'customer_name': cart.customer_name,
+        'items': items,
+        'total_amount': total_amount,
+        'problems': problems
+    }
+
+
 @billing_bp.route('/billing', methods=['GET', 'POST'])
 def index():
     if request.method == 'POST':
-        session['customer_name'] = request.form.get('customer_name')
-        session['customer_phone'] = request.form.get('customer_phone')
+        if 'user_id' not in session:
+            return redirect('/login')
+        # Only the cart id goes in the cookie; the cart itself is stored server-side
+        session['cart_id'] = open_cart(
+            session['user_id'],
+            request.form.get('customer_name'),
+            request.form.get('customer_phone')
+        )
         return redirect(url_for('billing.items'))
     return render_template('billing_customer.html')
 
 @billing_bp.route('/billing/items', methods=['GET'])
 def items():
-    if 'customer_name' not in session:
+    if 'user_id' not in session:
+        return redirect('/login')
+    cart = current_cart()
+    if cart is None:
         return redirect(url_for('billing.index'))
-    
-    # Fetch top 30 products for the billing list
-    products = Product.query.limit(30).all()
-    return render_template('billing_items.html', products=products, customer_name=session['customer_name'])
+
+    # First 30 products by name, after the ones already in the cart; the
+    # search box swaps in others from /api/products/search
+    lines = cart_lines(cart)
+    in_cart = [catalog.product(session['user_id'], pid) for pid in lines]
+    products = [p for p in in_cart if p is not None]
+    products += [p for p in search_products(session['user_id'], '', 30) if p.id not in lines]
+    return render_template('billing_items.html', products=products, lines=lines, customer_name=cart.customer_name)
 
 @billing_bp.route('/billing/checkout', methods=['POST'])
 def checkout():
-    total_amount = 0
-    items = []
-    
-    # Process form data
-    # Form data expected: product_ids (list), quantity_<id>
-    
-    selected_product_ids = request.form.getlist('product_ids')
-    
-    for pid in selected_product_ids:
-        qty = int(request.form.get(f'quantity_{pid}', 0))
-        if qty > 0:
-            product = Product.query.get(pid)
-            if product:
-                price = float(product.selling_price) if product.selling_price is not None else 0.0
-                item_total = round(price * qty, 2)
-                total_amount += item_total
-                items.append({
-                    'id': product.id,
-                    'name': product.name,
-                    'qty': qty,
-                    'price': price,
-                    'total': item_total
-                })
-    
-    if not items:
+    if 'user_id' not in session:
+        return redirect('/login')
+    cart = current_cart()
+    if cart is None:
+        return redirect(url_for('billing.index'))
+
+    # The page keeps the cart up to date through /api/cart; a form that
+    # still posts product_ids / quantity_<id> replaces the stored lines
+    if request.form.getlist('product_ids'):
+        quantities = {}
+        for pid in request.form.getlist('product_ids'):
+            qty = int(request.form.get(f'quantity_{pid}', 0))
+            if qty > 0 and pid.isdigit():
+                quantities[int(pid)] = qty
+        replace_lines(cart, quantities)
+    else:
+        quantities = cart_lines(cart)
+
+    if not quantities:
         # No items selected
         return redirect(url_for('billing.items'))
-        
-    # Store order in session to pass to payment page
-    session['current_order'] = {
+
+    # Whole cart priced from the cached catalog: no query per line
+    items, total_amount, problems = price_cart(quantities, catalog.get(session['user_id']).by_id)
+    if problems:
+        for message in problems:
+            flash(message, 'danger')
+        return redirect(url_for('billing.items'))
+
+    # The bill the payment page shows, and the total the sale is checked against
+    set_order(cart, {
         'items': items,
         'total_amount': total_amount,
-        'customer_name': session.get('customer_name'),
-        'customer_phone': session.get('customer_phone')
-    }
-    
+        'customer_name': cart.customer_name,
+        'customer_phone': cart.customer_phone
+    })
+
     return redirect(url_for('payment.checkout'))
+
+
+# ===== CART API =====
+@billing_bp.route('/api/cart')
+def cart_api():
+    cart = current_cart()
+    if cart is None:
+        return jsonify({'error': 'no open cart'}), 404
+    return jsonify(cart_summary(cart))
+
+@billing_bp.route('/api/cart/lines', methods=['POST'])
+def cart_line_api():
+    """Change one line: {"product_id" or "barcode", "qty": n} sets it, {"add": n} adds to it."""
+    cart = current_cart()
+    if cart is None:
+        return jsonify({'error': 'no open cart'}), 404
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'expected a JSON object'}), 400
+
+    if data.get('barcode'):
+        product = lookup_barcode(cart.user_id, str(data['barcode']))
+    else:
+        product = catalog.product(cart.user_id, data.get('product_id'))
+    if product is None:
+        return jsonify({'error': 'unknown product'}), 404
+    try:
+        qty = float(data['qty']) if 'qty' in data else None
+        add = float(data['add']) if 'add' in data else None
+    except (TypeError, ValueError):
+        return jsonify({'error': 'qty and add must be numbers'}), 400
+    if not all(math.isfinite(v) for v in (qty, add) if v is not None):
+        return jsonify({'error': 'qty and add must be numbers'}), 400
+    if qty is None and add is None:
+        return jsonify({'error': 'give qty or add'}), 400
+
+    set_line(cart, product.id, qty=qty, add=add)
+    return jsonify(cart_summary(cart))
+
+@billing_bp.route('/api/cart/lines/<int:product_id>', methods=['DELETE'])
+def cart_line_delete_api(product_id):
+    cart = current_cart()
+    if cart is None:
+        return jsonify({'error': 'no open cart'}), 404
+    set_line(cart, product_id, qty=0)
+    return jsonify(cart_summary(cart))
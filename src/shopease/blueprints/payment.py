@@ -1,10 +1,15 @@
-from flask import Blueprint, render_template, request, flash, redirect, url_for, send_file, session
-from models import db, Product, StockIn, Sale, Customer, KhataEntry, Transaction
-from blueprints.customers import upsert_customer
-import qrcode
-import io
+from flask import Blueprint, render_template, request, flash, redirect, url_for, session, jsonify, Response
+from models import db, Product, StockIn, Customer, KhataEntry, Transaction
+from checkout import checkout as sell_cart, checkout_batch, Cart, CheckoutError, PriceChanged
+from barcodes import lookup as lookup_barcode
+from stock import add_stock
+from sequences import sequences
+from upi import upi_link, qr_images, FORMATS
+from carts import get_order, set_order, close_cart
+from blueprints.billing import current_cart
+from periods import local_now
 import json
-from datetime import datetime
+import math
 
 payment_bp = Blueprint('payment', __name__)
 
@@ -17,117 +22,53 @@ def index(product_id):
 
 @payment_bp.route('/payment/checkout')
 def checkout():
-    if 'current_order' not in session:
-        return redirect(url_for('billing.index'))
-    order = session['current_order']
+    order = get_order(current_cart())
+    if order is None:
+        return redirect(url_for('billing.items'))
     amount = float(order['total_amount'])
     return render_template('payment.html', order=order, amount=amount, product=None, quantity=0)
 
 @payment_bp.route('/payment/process', methods=['POST'])
 def process_payment():
     payment_method = request.form.get('payment_method')
+    cart_row = current_cart() if request.form.get('is_cart') == 'true' else None
+    order = get_order(cart_row)
 
-    if 'current_order' in session and request.form.get('is_cart') == 'true':
+    if order is not None:
         # --- Cart Checkout ---
-        order = session['current_order']
-        
-        # Ensure all numeric values are floats (session may serialize Decimals as strings)
-        order_total = float(order['total_amount'])
-        
-        for item in order['items']:
-            item['price'] = float(item['price'])
-            item['total'] = float(item['total'])
-            product = Product.query.get(item['id'])
-            if product:
-                product.current_stock -= item['qty']
-                sale = Sale(
-                    product_id=product.id,
-                    quantity=item['qty'],
-                    selling_price=product.selling_price,
-                    cost_at_sale=product.cost_price,
-                    total_amount=item['total'],
-                    user_id=product.user_id,
-                    date=datetime.now()
-                )
-                db.session.add(sale)
-        db.session.commit()
-
-        # Generate invoice number: ddmmyyhhmm (Philosophy: DayMonthYearHourMinute)
-        invoice_no = datetime.now().strftime('%d%m%y%H%M')
-
-        # Update Customer Database (Excel)
-        upsert_customer(
-            name=order['customer_name'],
-            phone=order['customer_phone'],
-            amount=order_total,
-            invoice_no=invoice_no
-        )
-
-        # ---- KHATA HANDLING ----
-        if payment_method == 'Khata':
-            user_id = session.get('user_id')
-            customer_name = order['customer_name']
-            customer_phone = order['customer_phone']
-            description = request.form.get('khata_description', '').strip()
-
-            # Find or create Customer in Khatabook DB
-            customer = Customer.query.filter_by(
-                user_id=user_id,
-                phone=customer_phone
-            ).first()
-
-            if not customer:
-                customer = Customer(
-                    name=customer_name,
-                    phone=customer_phone,
-                    balance=0,
-                    user_id=user_id
-                )
-                db.session.add(customer)
-                db.session.commit()
-
-            # Create credit entry
-            entry = KhataEntry(
-                customer_id=customer.id,
-                entry_type='credit',
-                amount=order_total,
-                description=description or f'Invoice #{invoice_no}',
-                user_id=user_id
-            )
-            db.session.add(entry)
-            customer.balance = float(customer.balance or 0) + order_total
-            db.session.commit()
-
-        # Store invoice data in session for display
-        invoice_data = {
-            'invoice_no': invoice_no,
-            'customer_name': order['customer_name'],
-            'customer_phone': order['customer_phone'],
-            'items': order['items'],
-            'total_amount': order_total,
-            'payment_method': payment_method,
-            'date': datetime.now().strftime('%b %d, %Y')
-        }
-        session['last_invoice'] = invoice_data
-
-        # Save to Transaction History
-        txn = Transaction(
-            txn_type='invoice',
-            txn_ref=invoice_no,
+        cart = Cart(
+            items=order['items'],
             customer_name=order['customer_name'],
             customer_phone=order['customer_phone'],
-            amount=order_total,
             payment_method=payment_method,
-            data=json.dumps(invoice_data),
-            date=datetime.now(),
-            user_id=session.get('user_id')
+            khata_description=request.form.get('khata_description', ''),
+            expected_total=float(order['total_amount'])
         )
-        db.session.add(txn)
-        db.session.commit()
+        
+        # Sales, stock, Khata credit and history in one transaction
+        try:
+            invoice_data = sell_cart(session.get('user_id'), cart)
+        except PriceChanged as e:
+            set_order(cart_row, dict(order, items=e.items, total_amount=e.total_amount))
+            flash(e.messages[0], 'warning')
+            return redirect(url_for('payment.checkout'))
+        except CheckoutError as e:
+            for message in e.messages:
+                flash(message, 'danger')
+            return redirect(url_for('payment.checkout'))
+
+        # The invoice is in transaction history; the session only keeps its number
+        session['last_invoice'] = invoice_data['invoice_no']
 
-        session.pop('current_order', None)
+        close_cart(cart_row)
+        session.pop('cart_id', None)
         return redirect(url_for('payment.invoice'))
 
+    elif request.form.get('is_cart') == 'true':
+        # Paid already (a second click) or expired
+        flash('This bill is no longer open.', 'warning')
+        return redirect(url_for('billing.index'))
+
     else:
         # --- Stock Reorder ---
         product_id = request.form.get('product_id')
@@ -135,15 +76,16 @@ def process_payment():
         amount = float(request.form.get('amount'))
         product = Product.query.get(product_id)
         if product:
-            product.current_stock += quantity
             stock_in = StockIn(
                 product_id=product.id,
                 quantity=quantity,
                 cost_price=product.cost_price,
                 user_id=product.user_id,
-                date=datetime.now()
+                date=local_now()
             )
             db.session.add(stock_in)
+            db.session.flush()
+            add_stock(product.id, quantity, kind='reorder', ref_id=stock_in.id)
             db.session.commit()
             flash(f'Payment of ₹{amount:,.2f} successful via {payment_method}! Stock updated.', 'success')
         else:
@@ -152,9 +94,14 @@ def process_payment():
 
 @payment_bp.route('/payment/invoice')
 def invoice():
-    inv = session.get('last_invoice')
-    if not inv:
+    txn = None
+    if 'user_id' in session and session.get('last_invoice'):
+        txn = Transaction.query.filter_by(
+            user_id=session['user_id'], txn_ref=str(session['last_invoice'])
+        ).first()
+    if txn is None:
         return redirect(url_for('billing.index'))
+    inv = json.loads(txn.data)
     return render_template('invoice.html',
                            invoice_no=inv['invoice_no'],
                            customer_name=inv['customer_name'],
@@ -202,6 +149,9 @@ def khata_process_payment():
         flash('Unauthorized.', 'danger')
         return redirect(url_for('khatabook.index'))
     
+    # Reserved before anything is written (see sequences.py)
+    receipt_no = sequences.next(user_id, 'khata_receipt')
+    
     # Record payment in Khatabook
     entry = KhataEntry(
         customer_id=customer.id,
@@ -212,18 +162,18 @@ def khata_process_payment():
     )
     db.session.add(entry)
     customer.balance = float(customer.balance or 0) - amount
-    db.session.commit()
     
     # Store receipt in session
+    now = local_now()
     receipt_data = {
         'customer_name': customer.name,
         'customer_phone': customer.phone,
         'amount': amount,
         'payment_method': payment_method,
         'remaining_balance': float(customer.balance),
-        'date': datetime.now().strftime('%b %d, %Y'),
-        'time': datetime.now().strftime('%I:%M %p'),
-        'receipt_no': datetime.now().strftime('KP%d%m%y%H%M')
+        'date': now.strftime('%b %d, %Y'),
+        'time': now.strftime('%I:%M %p'),
+        'receipt_no': receipt_no
     }
     session['last_khata_receipt'] = receipt_data
 
@@ -236,15 +186,96 @@ def khata_process_payment():
         amount=amount,
         payment_method=payment_method,
         data=json.dumps(receipt_data),
-        date=datetime.now(),
+        date=now,
         user_id=user_id
     )
     db.session.add(txn)
-    db.session.commit()
+    db.session.commit()  # payment, balance and history together
     
     return redirect(url_for('payment.khata_receipt'))
 
 
+def cart_from_json(user_id, data):
+    """Cart from {"items": [{"product_id" or "barcode", "qty"}], "customer_name", ...}."""
+    if not isinstance(data, dict):
+        raise CheckoutError(['Each cart must be a JSON object'])
+    lines = data.get('items') or []
+    if not isinstance(lines, list):
+        raise CheckoutError(['items must be a list'])
+    items = []
+    for line in lines:
+        if not isinstance(line, dict):
+            raise CheckoutError(['Each item must be a JSON object'])
+        if line.get('barcode'):
+            product = lookup_barcode(user_id, str(line['barcode']))
+            if product is None:
+                raise CheckoutError([f"Unknown barcode {line['barcode']}"])
+            product_id = product.id
+        else:
+            try:
+                product_id = int(line['product_id'])
+            except (KeyError, TypeError, ValueError):
+                raise CheckoutError(['Each item needs a product_id or a barcode'])
+        try:
+            qty = float(line.get('qty', 1))
+        except (TypeError, ValueError):
+            qty = 0
+        if not (math.isfinite(qty) and qty > 0):
+            raise CheckoutError([f'Quantity for product #{product_id} must be positive'])
+        items.append({'id': product_id, 'qty': qty})
+    expected_total = data.get('expected_total')
+    if expected_total is not None:
+        try:
+            expected_total = float(expected_total)
+        except (TypeError, ValueError):
+            raise CheckoutError(['expected_total must be a number'])
+        if not math.isfinite(expected_total):
+            raise CheckoutError(['expected_total must be a number'])
+    for key in ('customer_name', 'customer_phone', 'payment_method', 'khata_description'):
+        if not isinstance(data.get(key), (str, type(None))):
+            raise CheckoutError([f'{key} must be a string'])
+    return Cart(
+        items=items,
+        customer_name=data.get('customer_name'),
+        customer_phone=data.get('customer_phone'),
+        payment_method=data.get('payment_method') or 'Cash',
+        khata_description=data.get('khata_description') or '',
+        expected_total=expected_total
+    )
+
+
+@payment_bp.route('/api/checkout', methods=['POST'])
+def checkout_api():
+    """JSON checkout of one cart, or {"carts": [...]} sold together with a single commit."""
+    if 'user_id' not in session:
+        return jsonify({'error': 'login required'}), 401
+    user_id = session['user_id']
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'expected a JSON object'}), 400
+    
+    raw_carts = data['carts'] if 'carts' in data else [data]
+    if not isinstance(raw_carts, list):
+        return jsonify({'error': 'carts must be a list'}), 400
+    
+    results = []
+    carts = []
+    for raw in raw_carts:
+        try:
+            carts.append((len(results), cart_from_json(user_id, raw)))
+            results.append(None)
+        except CheckoutError as e:
+            results.append({'errors': e.messages})
+    
+    sold = checkout_batch(user_id, [cart for _, cart in carts])
+    for (position, cart), (invoice, errors) in zip(carts, sold):
+        if invoice is None:
+            results[position] = {'errors': errors}
+        else:
+            results[position] = {'invoice_no': invoice['invoice_no'], 'total_amount': invoice['total_amount']}
+    return jsonify({'results': results})
+
+
 @payment_bp.route('/payment/khata_receipt')
 def khata_receipt():
     receipt = session.get('last_khata_receipt')
@@ -255,12 +286,18 @@ def khata_receipt():
 
 @payment_bp.route('/payment/qr_code')
 def qr_code():
-    upi_url = "upi://pay?pa=shopease@dummybank&pn=ShopEase&mc=1234&tid=1234567890&tr=1234567890&tn=StockReorder&am=0&cu=INR"
-    
-    img = qrcode.make(upi_url)
-    
-    buffer = io.BytesIO()
-    img.save(buffer, format="PNG")
-    buffer.seek(0)
-    
-    return send_file(buffer, mimetype='image/png')
+    """UPI QR for ?amount=&ref=; format=svg for the cheaper vector image."""
+    fmt = request.args.get('format', 'png')
+    if fmt not in FORMATS:
+        return 'Unsupported format', 400
+    amount = request.args.get('amount', type=float)
+    if amount is not None and not (0 < amount < 10 ** 7):
+        amount = None
+    ref = ''.join(c for c in request.args.get('ref', '') if c.isalnum() or c in '-_')[:35]
+
+    image, etag = qr_images.get(upi_link(amount, ref or None), fmt)
+    response = Response(image, mimetype=FORMATS[fmt])
+    response.set_etag(etag)
+    # The URL fully determines the image, so it never needs revalidating
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response.make_conditional(request)
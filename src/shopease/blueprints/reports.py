@@ -5,6 +5,8 @@ import pandas as pd
 import io
 from datetime import datetime, timedelta
 from decimal import Decimal
+import periods
+from profit import aggregate_profit
 
 reports_bp = Blueprint('reports', __name__)
 
@@ -32,11 +34,11 @@ def download_sales_pdf():
     pdf.set_font("Arial", size=12)
     
     # 30 Day Window
-    end_date = datetime.now()
-    start_date = end_date - timedelta(days=30)
+    window = periods.trailing(timedelta(days=30))
+    start_date, end_date = window.start, window.end
     
     # Sales Summary
-    sales = db.session.query(Sale).filter(Sale.date >= start_date).all()
+    sales = db.session.query(Sale).filter(window.where(Sale.date)).all()
     total_sales = sum((s.total_amount or Decimal(0)) for s in sales)
     total_items = sum((s.quantity or 0) for s in sales)
     
@@ -62,7 +64,7 @@ def download_sales_pdf():
     
     # Rows
     pdf.set_font("Arial", size=10)
-    recent_sales = db.session.query(Sale).filter(Sale.date >= start_date).order_by(Sale.date.desc()).all()
+    recent_sales = db.session.query(Sale).filter(window.where(Sale.date)).order_by(Sale.date.desc()).all()
     
     for sale in recent_sales:
         product = Product.query.get(sale.product_id)
@@ -126,23 +128,13 @@ def download_pnl_pdf():
     pdf.set_font("Arial", size=12)
     
     # Calculate Dates
-    end_date = datetime.now()
-    start_date = end_date - timedelta(days=30)
-    
-    # Fetch Sales (Revenue)
-    # Fetch Sales (Revenue)
-    sales = db.session.query(Sale).filter(Sale.date >= start_date).all()
-    # Handle possible None values in total_amount
-    total_revenue = sum((s.total_amount or Decimal(0)) for s in sales)
-    
-    # Calculate COGS (Cost of Goods Sold)
-    total_cogs = Decimal(0)
-    for sale in sales:
-        # Optim optimization: Pre-fetch products or allow N+1 for now (small scale)
-        product = Product.query.get(sale.product_id)
-        if product and product.cost_price is not None and sale.quantity is not None:
-             # Use current cost price as approximation since we don't track historical cost per batch yet
-            total_cogs += Decimal(str(sale.quantity)) * product.cost_price
+    window = periods.trailing(timedelta(days=30))
+    start_date, end_date = window.start, window.end
+    
+    # Revenue and COGS (cost snapshot at sale, else current cost) in one query
+    totals = aggregate_profit(period=window)
+    total_revenue = Decimal(str(totals.revenue))
+    total_cogs = Decimal(str(totals.cogs))
     gross_profit = total_revenue - total_cogs
     net_profit = gross_profit # Assuming no other expenses for now
     
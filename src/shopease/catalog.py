@@ -0,0 +1,153 @@
+"""Per-user product catalog kept in memory.
+
+The inventory, stock, prediction and billing pages all start from "every
+product this shop sells". Each user's catalog is loaded with one query
+into compact ProductRecord objects and served from memory until its
+catalog version moves: a committed Product insert, update or delete
+(picked up from the ORM session, like cache.py), or a stock UPDATE issued
+through stock.py (mark_changed). LRU bounds how many shops are held and a
+TTL covers writes this process cannot see (other gunicorn workers, the
+demo data generator).
+
+Records are read-only snapshots for display and price lookups. Writes go
+through the ORM or stock.py, never onto a record.
+"""
+from collections import OrderedDict
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models import db, Product
+
+FIELDS = ('id', 'name', 'category', 'unit', 'selling_price', 'cost_price',
+          'current_stock', 'reorder_level', 'barcode', 'user_id')
+
+
+class ProductRecord:
+    """Plain product row; __slots__ keeps a 50k-product catalog small."""
+    __slots__ = FIELDS
+
+    def __init__(self, *values):
+        for name, value in zip(FIELDS, values):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return f'<ProductRecord {self.id} {self.name!r}>'
+
+
+class Catalog:
+    """One user's products in id order, plus id and barcode lookups."""
+    __slots__ = ('records', 'by_id', 'by_barcode')
+
+    def __init__(self, records):
+        self.records = records
+        self.by_id = {r.id: r for r in records}
+        self.by_barcode = {r.barcode: r for r in records if r.barcode}
+
+
+def load_catalog(user_id):
+    rows = db.session.query(*[getattr(Product, name) for name in FIELDS]).filter(
+        Product.user_id == user_id
+    ).order_by(Product.id)
+    return Catalog([ProductRecord(*row) for row in rows])
+
+
+class CatalogCache:
+    """Thread-safe LRU of user_id -> Catalog, valid while the user's catalog version holds."""
+
+    def __init__(self, maxsize=64, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # user_id -> (version, expires, Catalog)
+        self._versions = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            version = self._versions.get(user_id, 0)
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] == version and entry[1] >= now:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+
+        catalog = load_catalog(user_id)
+        with self._lock:
+            # A commit during the load bumped the version: serve it, don't keep it
+            if self._versions.get(user_id, 0) == version:
+                self._entries[user_id] = (version, now + self.ttl, catalog)
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        return catalog
+
+    def products(self, user_id):
+        """Every product of `user_id`, in id order."""
+        return self.get(user_id).records
+
+    def product(self, user_id, product_id):
+        """One of `user_id`'s products, or None."""
+        try:
+            return self.get(user_id).by_id.get(int(product_id))
+        except (TypeError, ValueError):
+            return None
+
+    def bump(self, user_id):
+        with self._lock:
+            self._versions[user_id] = self._versions.get(user_id, 0) + 1
+
+    def forget(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'users': len(self._entries),
+                'products': sum(len(entry[2].records) for entry in self._entries.values()),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+catalog = CatalogCache()
+
+
+def mark_changed(session, user_id):
+    """Bump `user_id`'s catalog when `session` commits (for Core writes the ORM does not track)."""
+    if user_id is not None:
+        session.info.setdefault('catalog_user_ids', set()).add(int(user_id))
+
+
+# ===== WRITE TRACKING =====
+# Same pattern as cache.py: collect at flush, bump only once committed.
+@event.listens_for(Session, 'after_flush')
+def _collect_catalog_users(session, flush_context):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Product):
+            mark_changed(session, obj.user_id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _bump_catalog_users(session):
+    for user_id in session.info.pop('catalog_user_ids', ()):
+        catalog.bump(user_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_catalog_users(session):
+    session.info.pop('catalog_user_ids', None)
@@ -0,0 +1,250 @@
+"""Cart checkout as a single database transaction.
+
+A cart sale used to commit three times (sales and stock, the Khata
+customer and entry, the transaction history row), paying one fsync each
+and leaving half a sale behind if anything failed in between. checkout()
+writes all of it with bulk Core statements and commits once.
+checkout_batch() sends many carts through the same path and commits once
+for the whole batch; a cart that cannot be sold is skipped and reported
+without disturbing the others.
+
+Core inserts bypass the ORM's change tracking, so the KPI, ranking and
+cache bookkeeping normally picked up at flush is queued by hand. The
+customer directory (customer_profile) is updated in the same transaction.
+"""
+from dataclasses import dataclass
+import json
+
+from sqlalchemy import func, insert, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from models import db, Product, Sale, Customer, KhataEntry, Transaction, CustomerProfile
+from cache import mark_written
+from kpi import note_sales as note_kpi_sales
+from topk import note_sales as note_ranking_sales
+from rollup import upsert_rollups
+from stock import take_cart, OutOfStock
+from sequences import sequences
+import periods
+
+
+class CheckoutError(Exception):
+    """The cart cannot be sold as it stands; none of it was written."""
+
+    def __init__(self, messages):
+        self.messages = list(messages)
+        super().__init__('; '.join(self.messages))
+
+
+class PriceChanged(CheckoutError):
+    """Prices moved since the bill was shown; `items` and `total_amount` are the new bill."""
+
+    def __init__(self, items, total_amount):
+        self.items = items
+        self.total_amount = total_amount
+        super().__init__(['Prices changed since this bill was made. Please check the new total.'])
+
+
+@dataclass
+class Cart:
+    items: list                   # [{'id': product_id, 'qty': quantity, ...}]
+    customer_name: str = None
+    customer_phone: str = None
+    payment_method: str = 'Cash'
+    khata_description: str = ''
+    expected_total: float = None  # the total the customer was shown, if any
+
+
+def price_cart(quantities, products):
+    """Price and check a cart in memory, before anything is written.
+
+    `quantities` is {product_id: qty}, `products` maps those ids to product
+    rows or catalog records. Returns (items, total_amount, problems); the
+    problems use the same wording as stock.OutOfStock.
+    """
+    items = []
+    shortages = []
+    total_amount = 0
+    for pid, qty in quantities.items():
+        product = products.get(pid)
+        if product is None:
+            shortages.append({'product_id': pid, 'name': None, 'requested': qty, 'available': 0.0})
+            continue
+        available = float(product.current_stock or 0)
+        if qty > available:
+            shortages.append({'product_id': pid, 'name': product.name, 'requested': qty, 'available': available})
+        price = float(product.selling_price) if product.selling_price is not None else 0.0
+        item_total = round(price * qty, 2)
+        total_amount += item_total
+        items.append({
+            'id': product.id,
+            'name': product.name,
+            'qty': qty,
+            'price': price,
+            'total': item_total
+        })
+    return items, round(total_amount, 2), OutOfStock(shortages).messages()
+
+
+def load_products(user_id, product_ids):
+    """{id: row} for one shop's products, read fresh (not from the identity map)."""
+    rows = db.session.query(
+        Product.id, Product.name, Product.selling_price, Product.cost_price, Product.current_stock
+    ).filter(Product.user_id == user_id, Product.id.in_(product_ids))
+    return {row.id: row for row in rows}
+
+
+def checkout(user_id, cart):
+    """Sell one cart with a single commit. Returns the invoice dict; raises CheckoutError."""
+    # Numbers are reserved before the session writes (see sequences.py)
+    invoice_no = sequences.next(user_id, 'invoice')
+    try:
+        invoice = _sell(user_id, cart, invoice_no)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return invoice
+
+
+def checkout_batch(user_id, carts):
+    """Sell many carts with a single commit: [(invoice or None, error messages)] in cart order."""
+    results = []
+    invoice_numbers = sequences.take(user_id, 'invoice', len(carts))
+    try:
+        for cart, invoice_no in zip(carts, invoice_numbers):
+            try:
+                results.append((_sell(user_id, cart, invoice_no), []))
+            except CheckoutError as e:
+                results.append((None, e.messages))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return results
+
+
+def _sell(user_id, cart, invoice_no):
+    """Write one cart without committing; on CheckoutError nothing of it remains in the session."""
+    quantities = {}
+    for item in cart.items:
+        quantities[int(item['id'])] = quantities.get(int(item['id']), 0) + item['qty']
+    if not quantities:
+        raise CheckoutError(['The cart is empty.'])
+
+    # One IN query, then prices and stock are checked in memory
+    products = load_products(user_id, quantities)
+    items, total_amount, problems = price_cart(quantities, products)
+    if problems:
+        raise CheckoutError(problems)
+    if cart.expected_total is not None and abs(total_amount - float(cart.expected_total)) > 0.005:
+        raise PriceChanged(items, total_amount)
+
+    now = periods.local_now()
+
+    # One multi-row INSERT; lines are unique per product, so ids map back by product
+    sale_ids = dict(db.session.execute(
+        insert(Sale).returning(Sale.product_id, Sale.id),
+        [{
+            'product_id': item['id'],
+            'quantity': item['qty'],
+            'selling_price': products[item['id']].selling_price,
+            'cost_at_sale': products[item['id']].cost_price,
+            'total_amount': item['total'],
+            'user_id': user_id,
+            'date': now
+        } for item in items]
+    ).all())
+
+    # Every line or none; take_cart puts back what it took before failing
+    try:
+        take_cart([(item['id'], item['qty'], sale_ids[item['id']]) for item in items], user_id)
+    except OutOfStock as e:
+        db.session.execute(Sale.__table__.delete().where(Sale.__table__.c.id.in_(sale_ids.values())))
+        raise CheckoutError(e.messages())
+
+    upsert_rollups([{
+        'user_id': user_id,
+        'day': now.date(),
+        'product_id': item['id'],
+        'qty': float(item['qty']),
+        'revenue': item['total'],
+        'cost': float(item['qty']) * float(products[item['id']].cost_price or 0),
+        'txn_count': 1
+    } for item in items])
+    note_kpi_sales(db.session, [(user_id, now, item['total']) for item in items])
+    note_ranking_sales(db.session, [(user_id, now, item['id'], item['qty'], item['total']) for item in items])
+
+    if cart.customer_phone:
+        _record_customer(user_id, cart, total_amount, invoice_no, now)
+    if cart.payment_method == 'Khata':
+        _credit_khata(user_id, cart, total_amount, invoice_no)
+
+    invoice = {
+        'invoice_no': invoice_no,
+        'customer_name': cart.customer_name,
+        'customer_phone': cart.customer_phone,
+        'items': items,
+        'total_amount': total_amount,
+        'payment_method': cart.payment_method,
+        'date': now.strftime('%b %d, %Y')
+    }
+    db.session.execute(insert(Transaction).values(
+        txn_type='invoice',
+        txn_ref=invoice_no,
+        customer_name=cart.customer_name,
+        customer_phone=cart.customer_phone,
+        amount=total_amount,
+        payment_method=cart.payment_method,
+        data=json.dumps(invoice),
+        date=now,
+        user_id=user_id
+    ))
+    mark_written(db.session, user_id)
+    return invoice
+
+
+def _record_customer(user_id, cart, amount, invoice_no, now):
+    """Add the bill to the customer's directory totals (one upsert on idx_customer_profile_phone)."""
+    stmt = sqlite_insert(CustomerProfile).values(
+        user_id=user_id,
+        name=(cart.customer_name or '').strip() or cart.customer_phone,
+        phone=str(cart.customer_phone).strip(),
+        orders=1,
+        total_spent=amount,
+        last_invoice=invoice_no,
+        last_visit=now.date()
+    )
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=['user_id', 'phone'],
+        set_={
+            'name': stmt.excluded.name,
+            'orders': CustomerProfile.orders + 1,
+            'total_spent': CustomerProfile.total_spent + stmt.excluded.total_spent,
+            'last_invoice': stmt.excluded.last_invoice,
+            'last_visit': stmt.excluded.last_visit,
+        }
+    ))
+
+
+def _credit_khata(user_id, cart, amount, invoice_no):
+    """Put the bill on the customer's Khata, creating the customer on first credit."""
+    customer_id = db.session.query(Customer.id).filter_by(user_id=user_id, phone=cart.customer_phone).scalar()
+    if customer_id is None:
+        customer_id = db.session.execute(insert(Customer).returning(Customer.id).values(
+            name=cart.customer_name,
+            phone=cart.customer_phone,
+            balance=amount,
+            user_id=user_id
+        )).scalar_one()
+    else:
+        db.session.execute(update(Customer.__table__).where(Customer.__table__.c.id == customer_id).values(
+            balance=func.coalesce(Customer.__table__.c.balance, 0) + amount
+        ))
+    db.session.execute(insert(KhataEntry).values(
+        customer_id=customer_id,
+        entry_type='credit',
+        amount=amount,
+        description=(cart.khata_description or '').strip() or f'Invoice #{invoice_no}',
+        user_id=user_id
+    ))
@@ -0,0 +1,212 @@
+"""Running per-user sales KPIs kept in memory.
+
+Today's total, month-to-date, year-to-date and the all-time sale count are
+seeded from the database on first access, then moved by every committed
+Sale insert or delete (picked up from the ORM session, like cache.py) so
+reading them is a dict lookup. Counters roll over at day, month and year
+boundaries in the shop's timezone.
+
+Writes this process cannot see (other gunicorn workers, the demo data
+generator, hand edits) are caught by reconcile(), which re-reads the
+database every RECONCILE_INTERVAL seconds per user and records any drift.
+"""
+from dataclasses import dataclass, asdict
+import threading
+import time
+
+from sqlalchemy import case, event, func
+from sqlalchemy.orm import Session
+
+from models import db, Sale
+import periods
+
+RECONCILE_INTERVAL = 300
+DRIFT_TOLERANCE = 0.01
+KPI_FIELDS = ('today', 'month_to_date', 'year_to_date', 'transactions')
+
+
+@dataclass
+class Counters:
+    day: object
+    today: float = 0.0
+    month_to_date: float = 0.0
+    year_to_date: float = 0.0
+    transactions: int = 0
+    reconciled_at: float = 0.0
+
+    def roll_to(self, day):
+        """Zero the counters whose period ended before `day`."""
+        if day == self.day:
+            return
+        if (day.year, day.month) != (self.day.year, self.day.month):
+            self.month_to_date = 0.0
+        if day.year != self.day.year:
+            self.year_to_date = 0.0
+        self.today = 0.0
+        self.day = day
+
+    def add(self, when, amount, count):
+        """Apply one sale (or a negative one for a delete) stamped `when`."""
+        self.transactions += count
+        if when is None:
+            return
+        sale_day = when.date()
+        if sale_day.year == self.day.year and sale_day <= self.day:
+            self.year_to_date += amount
+            if sale_day.month == self.day.month:
+                self.month_to_date += amount
+                if sale_day == self.day:
+                    self.today += amount
+
+    def values(self):
+        return {name: getattr(self, name) for name in KPI_FIELDS}
+
+
+def load_counters(user_id, now=None):
+    """Aggregate the KPIs for one user straight from the sale table."""
+    now = now or periods.local_now()
+    today = periods.today(now)
+    month = periods.this_month(now)
+    year = periods.this_year(now)
+
+    def period_sum(period):
+        return func.coalesce(func.sum(case((period.where(Sale.date), Sale.total_amount), else_=0)), 0)
+
+    # Range-filtered to this year so SQLite walks idx_sale_user_date
+    row = db.session.query(
+        period_sum(today).label('today'),
+        period_sum(month).label('month'),
+        func.coalesce(func.sum(Sale.total_amount), 0).label('year')
+    ).filter(
+        Sale.user_id == user_id,
+        year.where(Sale.date)
+    ).one()
+    transactions = db.session.query(func.count(Sale.id)).filter(Sale.user_id == user_id).scalar() or 0
+
+    return Counters(
+        day=now.date(),
+        today=float(row.today),
+        month_to_date=float(row.month),
+        year_to_date=float(row.year),
+        transactions=int(transactions),
+        reconciled_at=time.monotonic()
+    )
+
+
+class KpiService:
+    """Thread-safe map of user_id -> Counters with drift reporting."""
+
+    def __init__(self, reconcile_interval=RECONCILE_INTERVAL):
+        self.reconcile_interval = reconcile_interval
+        self._lock = threading.Lock()
+        self._counters = {}
+        self.drift = []  # most recent reconciliation mismatches, newest last
+
+    def get(self, user_id, now=None):
+        """Current KPIs for a user: {today, month_to_date, year_to_date, transactions}."""
+        now = now or periods.local_now()
+        with self._lock:
+            counters = self._counters.get(user_id)
+            due = counters is None or time.monotonic() - counters.reconciled_at >= self.reconcile_interval
+            if not due:
+                counters.roll_to(now.date())
+                return counters.values()
+        if counters is None:
+            counters = load_counters(user_id, now)
+            with self._lock:
+                self._counters.setdefault(user_id, counters)
+            return counters.values()
+        return self.reconcile(user_id, now)
+
+    def apply(self, deltas):
+        """Fold committed sale deltas [(user_id, when, amount, count)] into loaded counters."""
+        now = periods.local_now().date()
+        with self._lock:
+            for user_id, when, amount, count in deltas:
+                counters = self._counters.get(user_id)
+                if counters is None:
+                    continue  # seeded from the database on first read, which already includes it
+                counters.roll_to(now)
+                counters.add(when, amount, count)
+
+    def forget(self, user_id=None):
+        """Drop loaded counters (one user, or all) so the next read reseeds them."""
+        with self._lock:
+            if user_id is None:
+                self._counters.clear()
+            else:
+                self._counters.pop(user_id, None)
+
+    def reconcile(self, user_id, now=None):
+        """Reload a user's counters from the database, recording any drift found."""
+        now = now or periods.local_now()
+        fresh = load_counters(user_id, now)
+        with self._lock:
+            current = self._counters.get(user_id)
+            if current is not None:
+                current.roll_to(fresh.day)
+                mismatches = {
+                    name: {'memory': getattr(current, name), 'database': getattr(fresh, name)}
+                    for name in KPI_FIELDS
+                    if abs(getattr(current, name) - getattr(fresh, name)) > DRIFT_TOLERANCE
+                }
+                if mismatches:
+                    self.drift.append({'user_id': user_id, 'at': now.isoformat(timespec='seconds'), 'fields': mismatches})
+                    del self.drift[:-50]
+                    print(f"KPI drift for user {user_id}: {mismatches}")
+            self._counters[user_id] = fresh
+        return fresh.values()
+
+    def report(self):
+        with self._lock:
+            return {
+                'users': len(self._counters),
+                'reconcile_interval': self.reconcile_interval,
+                'drift': list(self.drift),
+                'counters': {user_id: asdict(c, dict_factory=_json_safe) for user_id, c in self._counters.items()},
+            }
+
+
+def _json_safe(items):
+    return {k: (v.isoformat() if hasattr(v, 'isoformat') else v) for k, v in items if k != 'reconciled_at'}
+
+
+kpis = KpiService()
+
+
+def note_sales(session, sales):
+    """Queue sales inserted with Core [(user_id, when, amount)], applied when `session` commits."""
+    session.info.setdefault('kpi_deltas', []).extend(
+        (int(user_id), when, float(amount or 0), 1) for user_id, when, amount in sales
+    )
+
+
+# ===== WRITE TRACKING =====
+# Same pattern as cache.py: collect at flush, apply only once committed.
+@event.listens_for(Session, 'after_flush')
+def _collect_sale_deltas(session, flush_context):
+    deltas = session.info.setdefault('kpi_deltas', [])
+    for obj in session.new:
+        if isinstance(obj, Sale) and obj.user_id is not None:
+            deltas.append((int(obj.user_id), obj.date, float(obj.total_amount or 0), 1))
+    for obj in session.deleted:
+        if isinstance(obj, Sale) and obj.user_id is not None:
+            deltas.append((int(obj.user_id), obj.date, -float(obj.total_amount or 0), -1))
+    # Edited sales: old values are gone, so reseed those users on next read
+    stale = session.info.setdefault('kpi_stale_users', set())
+    for obj in session.dirty:
+        if isinstance(obj, Sale) and obj.user_id is not None and session.is_modified(obj):
+            stale.add(int(obj.user_id))
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_sale_deltas(session):
+    kpis.apply(session.info.pop('kpi_deltas', ()))
+    for user_id in session.info.pop('kpi_stale_users', ()):
+        kpis.forget(user_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_sale_deltas(session):
+    session.info.pop('kpi_deltas', None)
+    session.info.pop('kpi_stale_users', None)
@@ -18,6 +18,15 @@ class Product(db.Model):
     selling_price = db.Column(db.Numeric(10, 2))
     cost_price = db.Column(db.Numeric(10, 2))
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    reorder_level = db.Column(db.Float, nullable=False, default=10, server_default='10')
+    barcode = db.Column(db.String(64))  # EAN/UPC or shop SKU, unique per shop
+    # Partial index: only rows below their reorder level are in it, so the
+    # low-stock badge and watchlist read the affected products, not the catalog
+    __table_args__ = (
+        db.Index('idx_product_low_stock', 'user_id', 'current_stock',
+                 sqlite_where=db.text('current_stock < reorder_level')),
+        db.Index('idx_product_user_barcode', 'user_id', 'barcode', unique=True),
+    )
 
 class StockIn(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -47,6 +56,23 @@ class Customer(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     entries = db.relationship('KhataEntry', backref='customer', lazy=True)
 
+class CustomerProfile(db.Model):
+    """Customer directory: one row per shop and phone, totals kept up by checkout."""
+    __tablename__ = 'customer_profile'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    name = db.Column(db.String(200), nullable=False)
+    phone = db.Column(db.String(20), nullable=False)
+    orders = db.Column(db.Integer, nullable=False, default=0)
+    total_spent = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+    last_invoice = db.Column(db.String(50))
+    last_visit = db.Column(db.Date)
+    __table_args__ = (
+        db.Index('idx_customer_profile_phone', 'user_id', 'phone', unique=True),
+        # Covers the page's ranking and its count/sum totals without touching the table
+        db.Index('idx_customer_profile_spent', 'user_id', 'total_spent'),
+    )
+
 class KhataEntry(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=False)
@@ -67,4 +93,66 @@ class Transaction(db.Model):
     data = db.Column(db.Text)                                  # JSON blob with full details
     date = db.Column(db.DateTime, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    __table_args__ = (
+        db.Index('idx_transaction_user_ref', 'user_id', 'txn_ref', unique=True),
+    )
+
+
+class SequenceCounter(db.Model):
+    """Next unallocated invoice / receipt number per shop (see sequences.py)."""
+    __tablename__ = 'sequence_counter'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    name = db.Column(db.String(20), primary_key=True)   # 'invoice' or 'khata_receipt'
+    next_value = db.Column(db.Integer, nullable=False, default=1)
+
+
+class OpenCart(db.Model):
+    """A bill being put together at the counter; the session only holds its id (see carts.py)."""
+    __tablename__ = 'open_cart'
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    customer_name = db.Column(db.String(200))
+    customer_phone = db.Column(db.String(20))
+    order_data = db.Column(db.Text)                    # JSON of the priced bill once it goes to payment
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+
+class OpenCartLine(db.Model):
+    __tablename__ = 'open_cart_line'
+    cart_id = db.Column(db.String(32), db.ForeignKey('open_cart.id'), primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    qty = db.Column(db.Float, nullable=False)
+
+
+class DailyProductRollup(db.Model):
+    """Per-day, per-product sales totals, maintained alongside every Sale insert."""
+    __tablename__ = 'daily_product_rollup'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    qty = db.Column(db.Float, nullable=False, default=0)
+    revenue = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+    cost = db.Column(db.Numeric(12, 2), nullable=False, default=0)        # Sum of quantity * unit cost
+    txn_count = db.Column(db.Integer, nullable=False, default=0)
+
+
+class StockMovement(db.Model):
+    """Append-only ledger of every change to a product's stock (delta > 0 adds)."""
+    __tablename__ = 'stock_movement'
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    delta = db.Column(db.Float, nullable=False)
+    kind = db.Column(db.String(20), nullable=False)   # sale, stock_in, reorder, adjustment, opening
+    ref_id = db.Column(db.Integer)                    # sale.id / stock_in.id when known
+    note = db.Column(db.String(200))
+    date = db.Column(db.DateTime, default=datetime.utcnow)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    __table_args__ = (db.Index('idx_movement_product_date', 'product_id', 'date'),)
+
 
+class StockSnapshot(db.Model):
+    """Stock level of a product at the start of `day` (all movements dated before it)."""
+    __tablename__ = 'stock_snapshot'
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    quantity = db.Column(db.Float, nullable=False)
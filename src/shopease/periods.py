@@ -0,0 +1,153 @@
+"""Reporting periods as half-open [start, end) ranges.
+
+Timestamps are stored as naive shop-local wall-clock time, so every period
+is computed in the shop's timezone and compared against the raw column.
+Filtering on the bare column (instead of func.date() / extract()) lets
+SQLite use idx_sale_user_date and friends.
+
+The shop timezone comes from the SHOP_TIMEZONE environment variable
+(e.g. "Asia/Kolkata") and defaults to the machine's local timezone.
+"""
+from datetime import datetime, date, time, timedelta
+from zoneinfo import ZoneInfo
+from sqlalchemy import String, and_, literal
+import os
+
+
+def shop_timezone():
+    """tzinfo used for day/month/year boundaries."""
+    name = os.environ.get('SHOP_TIMEZONE')
+    if name:
+        return ZoneInfo(name)
+    return datetime.now().astimezone().tzinfo
+
+
+def now():
+    """Timezone-aware current time in the shop's timezone."""
+    return datetime.now(shop_timezone())
+
+
+def local_now():
+    """Naive shop-local wall-clock time, the format timestamps are stored in."""
+    return now().replace(tzinfo=None)
+
+
+def _aware(dt):
+    """Attach the shop timezone to naive datetimes; convert aware ones into it."""
+    tz = shop_timezone()
+    if dt is None:
+        return datetime.now(tz)
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=tz)
+    return dt.astimezone(tz)
+
+
+def _midnight(d):
+    return datetime.combine(d, time(), tzinfo=shop_timezone())
+
+
+def as_stored(dt):
+    """Render a bound for a DateTime column the way SQLite stores the values.
+
+    Stored values omit '.000000' for whole seconds, so a boundary bound as
+    'YYYY-MM-DD 00:00:00.000000' would sort after a sale stamped exactly at
+    midnight. Whole-second bounds are therefore rendered without a fraction.
+    """
+    naive = _aware(dt).replace(tzinfo=None)
+    fmt = '%Y-%m-%d %H:%M:%S.%f' if naive.microsecond else '%Y-%m-%d %H:%M:%S'
+    return literal(naive.strftime(fmt), String)
+
+
+class Period:
+    """A half-open [start, end) range of timezone-aware datetimes."""
+
+    def __init__(self, start, end):
+        self.start = _aware(start)
+        self.end = _aware(end)
+
+    def __repr__(self):
+        return f'Period({self.start.isoformat()}, {self.end.isoformat()})'
+
+    def __contains__(self, dt):
+        return self.start <= _aware(dt) < self.end
+
+    def where(self, column):
+        """Range predicate for a DateTime column."""
+        return and_(column >= as_stored(self.start), column < as_stored(self.end))
+
+    @property
+    def first_day(self):
+        return self.start.date()
+
+    @property
+    def end_day(self):
+        """First calendar day not touched by the period."""
+        end = self.end
+        if end.time() == time():
+            return end.date()
+        return end.date() + timedelta(days=1)
+
+    def where_day(self, column):
+        """Range predicate for a Date column (e.g. the daily rollup).
+
+        Partial days at either end are included whole.
+        """
+        return and_(column >= self.first_day, column < self.end_day)
+
+    def days(self):
+        """Calendar dates covered by the period, oldest first."""
+        d, end = self.first_day, self.end_day
+        result = []
+        while d < end:
+            result.append(d)
+            d += timedelta(days=1)
+        return result
+
+
+def between(start, end):
+    """Arbitrary [start, end) range."""
+    return Period(start, end)
+
+
+def day(d):
+    """A single calendar day."""
+    if isinstance(d, datetime):
+        d = _aware(d).date()
+    return Period(_midnight(d), _midnight(d + timedelta(days=1)))
+
+
+def today(now=None):
+    return day(_aware(now).date())
+
+
+def month(year, month):
+    """A calendar month."""
+    next_year, next_month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return Period(_midnight(date(year, month, 1)), _midnight(date(next_year, next_month, 1)))
+
+
+def this_month(now=None):
+    current = _aware(now)
+    return month(current.year, current.month)
+
+
+def year(year):
+    """A calendar year."""
+    return Period(_midnight(date(year, 1, 1)), _midnight(date(year + 1, 1, 1)))
+
+
+def this_year(now=None):
+    return year(_aware(now).year)
+
+
+def last_n_days(n, now=None):
+    """The last n whole calendar days, today included."""
+    current = _aware(now).date()
+    return Period(_midnight(current - timedelta(days=n - 1)), _midnight(current + timedelta(days=1)))
+
+
+def trailing(delta, now=None):
+    """Rolling window ending now, e.g. trailing(timedelta(days=7))."""
+    current = _aware(now)
+    return Period(current - delta, current)
+
@@ -0,0 +1,71 @@
+"""Profit aggregation in SQL with a single cost basis.
+
+A sale's unit cost is the cost snapshot taken at checkout (cost_at_sale),
+falling back to the product's current cost_price for older rows that have
+no snapshot. Every profit figure in the app (P&L report, daily summary
+CSV, the daily rollup behind analytics) uses this definition.
+"""
+from sqlalchemy import func, select
+from sqlalchemy.dialects import sqlite
+
+from models import db, Product, Sale
+
+unit_cost = func.coalesce(Sale.cost_at_sale, Product.cost_price)
+cogs = Sale.quantity * unit_cost
+profit = Sale.quantity * (Sale.selling_price - unit_cost)
+
+DIMENSIONS = {
+    'day': func.date(Sale.date),
+    'month': func.strftime('%Y-%m', Sale.date),
+    'year': func.strftime('%Y', Sale.date),
+    'weekday': func.strftime('%w', Sale.date),  # 0 = Sunday
+    'hour': func.strftime('%H', Sale.date),
+    'product': Sale.product_id,
+    'category': Product.category,
+}
+
+
+def profit_select(user_id=None, period=None, by=None):
+    """Core SELECT of revenue, cogs, profit, items and transactions.
+
+    user_id -- restrict to one shop (None = all users)
+    period  -- a periods.Period to restrict Sale.date to
+    by      -- a DIMENSIONS name or column expression to group on; the
+               group key is returned as the 'key' column
+    """
+    columns = [
+        func.coalesce(func.sum(Sale.total_amount), 0).label('revenue'),
+        func.coalesce(func.sum(cogs), 0).label('cogs'),
+        func.coalesce(func.sum(profit), 0).label('profit'),
+        func.coalesce(func.sum(Sale.quantity), 0).label('items'),
+        func.count(Sale.id).label('transactions'),
+    ]
+    key = DIMENSIONS.get(by, by) if by is not None else None
+    if key is not None:
+        columns.insert(0, key.label('key'))
+
+    stmt = select(*columns).select_from(Sale).outerjoin(Product, Product.id == Sale.product_id)
+    if user_id is not None:
+        stmt = stmt.where(Sale.user_id == user_id)
+    if period is not None:
+        stmt = stmt.where(period.where(Sale.date))
+    if key is not None:
+        stmt = stmt.group_by(key).order_by(key)
+    return stmt
+
+
+def aggregate_profit(user_id=None, period=None, by=None):
+    """Run profit_select() on the app session.
+
+    Returns a single row when `by` is None, otherwise a list of rows
+    ordered by key.
+    """
+    result = db.session.execute(profit_select(user_id, period, by))
+    if by is None:
+        return result.one()
+    return result.all()
+
+
+def compile_for_sqlite(stmt):
+    """Render a statement as plain SQL for callers on a raw sqlite3 connection."""
+    return str(stmt.compile(dialect=sqlite.dialect(), compile_kwargs={'literal_binds': True}))
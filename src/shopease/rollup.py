@@ -0,0 +1,109 @@
+"""Maintenance of the daily_product_rollup table.
+
+Every Sale insert must be paired with record_sale() in the same
+transaction so the rollup never drifts from the raw sale table.
+rebuild_daily_rollup() regenerates it from scratch for existing databases.
+"""
+from sqlalchemy import func, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from models import db, Product, Sale, DailyProductRollup
+from profit import cogs
+import periods
+
+
+def _accumulate(stmt):
+    excluded = stmt.excluded
+    return stmt.on_conflict_do_update(
+        index_elements=['user_id', 'day', 'product_id'],
+        set_={
+            'qty': DailyProductRollup.qty + excluded.qty,
+            'revenue': DailyProductRollup.revenue + excluded.revenue,
+            'cost': DailyProductRollup.cost + excluded.cost,
+            'txn_count': DailyProductRollup.txn_count + excluded.txn_count,
+        }
+    )
+
+
+def upsert_rollup(user_id, day, product_id, qty, revenue, cost, txn_count=1):
+    """Add one delta to the (user, day, product) bucket. Does not commit."""
+    db.session.execute(_accumulate(sqlite_insert(DailyProductRollup).values(
+        user_id=user_id,
+        day=day,
+        product_id=product_id,
+        qty=qty,
+        revenue=revenue,
+        cost=cost,
+        txn_count=txn_count
+    )))
+
+
+def upsert_rollups(deltas):
+    """upsert_rollup() for many buckets in one executemany; dicts of the same keys. Does not commit."""
+    if deltas:
+        db.session.execute(_accumulate(sqlite_insert(DailyProductRollup)), deltas)
+
+
+def record_sale(sale, product=None):
+    """Fold a new (not yet committed) Sale into the rollup."""
+    if sale.product_id is None or sale.user_id is None:
+        return
+    # Pin the timestamp now so the sale row and its rollup bucket agree on the day
+    if sale.date is None:
+        sale.date = periods.local_now()
+
+    # Same cost basis as profit.unit_cost: snapshot first, then current product cost
+    unit_cost = sale.cost_at_sale
+    if unit_cost is None and product is not None:
+        unit_cost = product.cost_price
+    quantity = float(sale.quantity or 0)
+
+    upsert_rollup(
+        user_id=sale.user_id,
+        day=sale.date.date(),
+        product_id=int(sale.product_id),
+        qty=quantity,
+        revenue=float(sale.total_amount or 0),
+        cost=quantity * float(unit_cost or 0)
+    )
+
+
+def rebuild_daily_rollup(user_id=None):
+    """Recompute the rollup from the sale table (all users, or just one). Commits."""
+    delete = DailyProductRollup.__table__.delete()
+    if user_id is not None:
+        delete = delete.where(DailyProductRollup.user_id == user_id)
+    db.session.execute(delete)
+
+    day = func.date(Sale.date)
+    source = select(
+        Sale.user_id,
+        day,
+        Sale.product_id,
+        func.sum(Sale.quantity),
+        func.sum(Sale.total_amount),
+        func.coalesce(func.sum(cogs), 0),
+        func.count(Sale.id)
+    ).outerjoin(Product, Product.id == Sale.product_id).where(
+        Sale.user_id.isnot(None),
+        Sale.product_id.isnot(None),
+        Sale.date.isnot(None)
+    ).group_by(Sale.user_id, day, Sale.product_id)
+    if user_id is not None:
+        source = source.where(Sale.user_id == user_id)
+
+    table = DailyProductRollup.__table__
+    db.session.execute(table.insert().from_select(
+        ['user_id', 'day', 'product_id', 'qty', 'revenue', 'cost', 'txn_count'], source
+    ))
+    db.session.commit()
+
+
+def ensure_daily_rollup():
+    """Backfill the rollup for databases created before it existed."""
+    has_sales = db.session.query(Sale.id).first() is not None
+    has_rollup = db.session.query(DailyProductRollup.user_id).first() is not None
+    if has_sales and not has_rollup:
+        rebuild_daily_rollup()
+        return True
+    return False
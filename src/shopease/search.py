@@ -0,0 +1,141 @@
+"""Product search for the billing counter.
+
+Every word of a product's name, category and barcode goes into a sorted
+vocabulary with a posting list of the products using it, so a query word
+matches by prefix with two bisects and the result is a set union. When
+the exact prefixes find fewer than `limit` products, words one edit away
+from the query word (a missing, extra, wrong or swapped letter) are tried
+as prefixes too, ranked after the exact matches.
+
+Indexes are built from the in-memory catalog (catalog.py) and reused
+across catalog reloads while no product was added, removed, renamed or
+relabelled, so the stock changes that come with every sale do not rebuild
+them.
+"""
+from bisect import bisect_left
+from collections import OrderedDict
+import heapq
+import re
+import string
+import threading
+
+from catalog import catalog
+
+TOKEN = re.compile(r'[0-9a-z]+')
+ALPHABET = string.ascii_lowercase + string.digits
+MIN_TYPO_LENGTH = 3  # shorter words have too many neighbours to be useful
+
+
+def tokens(text):
+    return TOKEN.findall((text or '').lower())
+
+
+def one_edit_away(word):
+    """Every string one deletion, insertion, substitution or transposition from `word`."""
+    splits = [(word[:i], word[i:]) for i in range(len(word) + 1)]
+    variants = set()
+    for left, right in splits:
+        if right:
+            variants.add(left + right[1:])
+            variants.update(left + c + right[1:] for c in ALPHABET)
+            if len(right) > 1:
+                variants.add(left + right[1] + right[0] + right[2:])
+        variants.update(left + c + right for c in ALPHABET)
+    variants.discard(word)
+    return variants
+
+
+class SearchIndex:
+    """Prefix index over one catalog; products are numbered in name order."""
+
+    def __init__(self, records):
+        ordered = sorted(records, key=lambda r: ((r.name or '').lower(), r.id))
+        self.product_ids = [r.id for r in ordered]
+        postings = {}
+        for rank, record in enumerate(ordered):
+            for word in tokens(record.name) + tokens(record.category) + tokens(record.barcode):
+                postings.setdefault(word, set()).add(rank)
+        self.words = sorted(postings)
+        self.postings = [postings[word] for word in self.words]
+
+    def prefix(self, word):
+        """Ranks of the products with a word starting with `word`."""
+        start = bisect_left(self.words, word)
+        end = bisect_left(self.words, word + '\uffff', start)
+        if end - start == 1:
+            return self.postings[start]
+        matched = set()
+        for posting in self.postings[start:end]:
+            matched |= posting
+        return matched
+
+    def search(self, query, limit=10):
+        """Product ids matching every query word, exact prefixes first, then in name order."""
+        words = tokens(query)
+        if not words:
+            return self.product_ids[:limit]
+
+        exact = [self.prefix(word) for word in words]
+        found = set.intersection(*exact)
+        results = heapq.nsmallest(limit, found)
+        if len(results) >= limit:
+            return [self.product_ids[rank] for rank in results]
+
+        # Typo pass: words that match nothing (or, failing that, the word
+        # still being typed) may also match one edit away
+        suspects = [i for i, matched in enumerate(exact) if not matched] or [len(words) - 1]
+        loose = list(exact)
+        for i in suspects:
+            if len(words[i]) >= MIN_TYPO_LENGTH:
+                loose[i] = set(exact[i])
+                for variant in one_edit_away(words[i]):
+                    loose[i] |= self.prefix(variant)
+        typos = set.intersection(*sorted(loose, key=len)) - found
+        results += heapq.nsmallest(limit - len(results), typos)
+        return [self.product_ids[rank] for rank in results]
+
+
+def fingerprint(records):
+    return hash(tuple((r.id, r.name, r.category, r.barcode) for r in records))
+
+
+class SearchIndexes:
+    """Thread-safe LRU of user_id -> SearchIndex, rebuilt only when names change."""
+
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # user_id -> (Catalog, fingerprint, SearchIndex)
+
+    def get(self, user_id, current):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                self._entries.move_to_end(user_id)
+                if entry[0] is current:
+                    return entry[2]
+        key = fingerprint(current.records)
+        index = entry[2] if entry is not None and entry[1] == key else SearchIndex(current.records)
+        with self._lock:
+            self._entries[user_id] = (current, key, index)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return index
+
+    def forget(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+
+search_indexes = SearchIndexes()
+
+
+def search_products(user_id, query, limit=10):
+    """Up to `limit` of the user's ProductRecords matching `query`."""
+    current = catalog.get(user_id)
+    index = search_indexes.get(user_id, current)
+    return [current.by_id[pid] for pid in index.search(query, limit) if pid in current.by_id]
@@ -0,0 +1,104 @@
+"""UPI payment QR codes.
+
+A QR code depends only on its payment link (payee, amount, reference,
+note), so rendered images are kept in an LRU keyed by those values and
+served with a strong ETag and immutable cache headers: the same bill
+rendered twice costs one encode, and a browser asking again gets a 304.
+PNG goes through Pillow; SVG is written straight from the module
+matrix as a single path, skipping rasterising and PNG compression.
+"""
+from collections import OrderedDict
+import hashlib
+import io
+import threading
+from urllib.parse import urlencode, quote
+
+import qrcode
+
+UPI_ID = 'shopease@dummybank'
+PAYEE_NAME = 'ShopEase'
+MERCHANT_CODE = '1234'
+FORMATS = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+}
+
+
+def upi_link(amount=None, ref=None, note='ShopEase bill'):
+    """upi://pay link for `amount` rupees (None leaves it for the payer to enter)."""
+    params = [('pa', UPI_ID), ('pn', PAYEE_NAME), ('mc', MERCHANT_CODE)]
+    if ref:
+        params.append(('tr', ref))
+    params.append(('tn', note))
+    if amount is not None:
+        params.append(('am', f'{amount:.2f}'))
+    params.append(('cu', 'INR'))
+    return 'upi://pay?' + urlencode(params, quote_via=quote)
+
+
+def svg_image(matrix, scale=10):
+    """The module matrix as one SVG path, a horizontal run of dark modules per segment."""
+    size = len(matrix)
+    runs = []
+    for y, row in enumerate(matrix):
+        x = 0
+        while x < size:
+            if row[x]:
+                start = x
+                while x < size and row[x]:
+                    x += 1
+                runs.append(f'M{start},{y}h{x - start}v1h-{x - start}z')
+            else:
+                x += 1
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{size * scale}" height="{size * scale}" '
+        f'viewBox="0 0 {size} {size}" shape-rendering="crispEdges">'
+        f'<rect width="{size}" height="{size}" fill="#fff"/><path fill="#000" d="{"".join(runs)}"/></svg>'
+    ).encode()
+
+
+def render_qr(data, fmt='png'):
+    qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_M, box_size=10, border=4)
+    qr.add_data(data)
+    qr.make(fit=True)
+    if fmt == 'svg':
+        return svg_image(qr.get_matrix())
+    buffer = io.BytesIO()
+    qr.make_image().save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+class QRCache:
+    """Thread-safe LRU of (format, link) -> (image bytes, ETag)."""
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, link, fmt='png'):
+        key = (fmt, link)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+        image = render_qr(link, fmt)
+        entry = (image, hashlib.sha256(image).hexdigest()[:32])
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return entry
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses}
+
+
+qr_images = QRCache()
@@ -0,0 +1,167 @@
+"""Atomic stock movements.
+
+Stock is never read into Python, adjusted and written back: two billing
+counters doing that at once lose one of the updates. Every change is a
+single UPDATE evaluated by SQLite, and decrements carry the availability
+check in their WHERE clause; the row they RETURN (the owner's user_id,
+for cache invalidation) says whether they applied. Each applied change
+is also appended to the stock ledger (ledger.py). None of these
+functions commit; callers commit or roll back the whole cart together.
+
+Products below their own reorder_level form the low-stock watchlist. The
+partial index idx_product_low_stock holds exactly those rows, so SQLite
+keeps it current on every stock UPDATE and the badge and watchlist read
+only the affected products.
+"""
+from sqlalchemy import update
+
+from models import db, Product
+from ledger import record_movement, record_movements
+from cache import mark_written
+from catalog import mark_changed as mark_catalog_changed
+import periods
+
+
+class OutOfStock(Exception):
+    """One or more lines could not be taken from stock."""
+
+    def __init__(self, shortages):
+        self.shortages = shortages  # [{'product_id', 'name', 'requested', 'available'}]
+        super().__init__('; '.join(self.messages()))
+
+    def messages(self):
+        lines = []
+        for s in self.shortages:
+            if s['name'] is None:
+                lines.append(f"Product #{s['product_id']} is no longer available")
+            else:
+                lines.append(f"Not enough stock for {s['name']}: requested {s['requested']:g}, available {s['available']:g}")
+        return lines
+
+
+def _touched(user_id):
+    # Core UPDATEs bypass the ORM's change tracking: flag the owner by hand
+    mark_written(db.session, user_id)
+    mark_catalog_changed(db.session, user_id)
+
+
+def take_stock(product_id, quantity, kind='sale', ref_id=None, note=None):
+    """Decrement stock if at least `quantity` is available. Returns True if applied."""
+    row = db.session.execute(
+        update(Product)
+        .where(Product.id == product_id, Product.current_stock >= quantity)
+        .values(current_stock=Product.current_stock - quantity)
+        .returning(Product.user_id)
+    ).first()
+    if row is None:
+        return False
+    _touched(row.user_id)
+    record_movement(product_id, -quantity, kind, ref_id=ref_id, note=note)
+    return True
+
+
+def add_stock(product_id, quantity, kind='stock_in', ref_id=None, note=None):
+    """Increment stock (deliveries, reorders). Returns True if the product exists."""
+    row = db.session.execute(
+        update(Product)
+        .where(Product.id == product_id)
+        .values(current_stock=Product.current_stock + quantity)
+        .returning(Product.user_id)
+    ).first()
+    if row is None:
+        return False
+    _touched(row.user_id)
+    record_movement(product_id, quantity, kind, ref_id=ref_id, note=note)
+    return True
+
+
+def adjust_stock(product_id, delta, note=None):
+    """Manual correction (damage, stock count). Refuses to go below zero."""
+    if delta < 0:
+        return take_stock(product_id, -delta, kind='adjustment', note=note)
+    return add_stock(product_id, delta, kind='adjustment', note=note)
+
+
+def take_cart(lines, user_id, kind='sale'):
+    """Take every (product_id, quantity[, ref_id]) line of `user_id`'s cart from stock, or none.
+
+    Lines go one conditional UPDATE at a time. If any falls short, the ones
+    already taken are put back and OutOfStock lists every failing line.
+    Nothing else in the session is touched, so a batch of carts sharing
+    one transaction loses only the failing cart. On success the cart's
+    ledger rows are written with a single executemany.
+    """
+    table = Product.__table__
+    taken = []
+    shortages = []
+    for product_id, quantity, *ref in lines:
+        result = db.session.execute(
+            update(table)
+            .where(table.c.id == product_id, table.c.current_stock >= quantity)
+            .values(current_stock=table.c.current_stock - quantity)
+        )
+        if result.rowcount == 1:
+            taken.append((product_id, quantity, ref[0] if ref else None))
+        else:
+            shortages.append((int(product_id), float(quantity)))
+
+    if shortages:
+        # This transaction holds SQLite's write lock from the first UPDATE
+        # on, so no one else touched these rows: adding back is an exact undo
+        for product_id, quantity, _ in taken:
+            db.session.execute(
+                update(table).where(table.c.id == product_id).values(current_stock=table.c.current_stock + quantity)
+            )
+        products = {row.id: row for row in db.session.query(Product.id, Product.name, Product.current_stock).filter(
+            Product.id.in_({pid for pid, _ in shortages})
+        )}
+        raise OutOfStock([
+            {
+                'product_id': pid,
+                'name': products[pid].name if pid in products else None,
+                'requested': qty,
+                'available': float(products[pid].current_stock or 0) if pid in products else 0.0,
+            }
+            for pid, qty in shortages
+        ])
+
+    now = periods.local_now()
+    record_movements([
+        {'product_id': product_id, 'delta': -quantity, 'kind': kind, 'ref_id': ref_id,
+         'note': None, 'date': now, 'user_id': user_id}
+        for product_id, quantity, ref_id in taken
+    ])
+    _touched(user_id)
+
+
+def low_stock_query(user_id):
+    """Products of `user_id` below their reorder level.
+
+    The filter repeats idx_product_low_stock's WHERE clause word for word;
+    SQLite only uses a partial index when the query implies its condition.
+    """
+    return Product.query.filter(
+        Product.user_id == user_id,
+        Product.current_stock < Product.reorder_level
+    )
+
+
+def low_stock_count(user_id):
+    return low_stock_query(user_id).count()
+
+
+def watchlist(user_id):
+    """Reorder watchlist, emptiest relative to its reorder level first."""
+    items = [
+        {
+            'product_id': p.id,
+            'name': p.name,
+            'unit': p.unit,
+            'current_stock': float(p.current_stock or 0),
+            'reorder_level': float(p.reorder_level),
+            'shortfall': float(p.reorder_level) - float(p.current_stock or 0),
+        }
+        for p in low_stock_query(user_id)
+    ]
+    items.sort(key=lambda i: (i['current_stock'] / i['reorder_level'] if i['reorder_level'] else 0, i['product_id']))
+    return items
@@ -0,0 +1,62 @@
+"""Shared fixtures: the app on a scratch SQLite file, rebuilt for every test."""
+import os
+import tempfile
+
+import pytest
+
+# Must be set before app.py is imported: it binds the database at import time
+_scratch = tempfile.mkdtemp(prefix='shopease-tests-')
+os.environ['SHOPEASE_DATABASE_URI'] = 'sqlite:///' + os.path.join(_scratch, 'shop.db')
+
+import app as shop  # noqa: E402
+from models import db, User, Product  # noqa: E402
+from cache import invalidate_all, result_cache  # noqa: E402
+from search import search_indexes  # noqa: E402
+from sequences import sequences  # noqa: E402
+from stock import add_stock  # noqa: E402
+
+
+@pytest.fixture
+def app():
+    with shop.app.app_context():
+        db.drop_all()
+        db.create_all()
+        shop.upgrade_schema()
+        db.session.add_all([
+            User(id=1, username='demo_shop', password='x', shop_name='Demo Shop'),
+            User(id=2, username='other_shop', password='x', shop_name='Other Shop'),
+        ])
+        db.session.commit()
+    shop.optimize_db()
+
+    # In-memory state from the previous test's database
+    invalidate_all()
+    result_cache.clear()
+    search_indexes.forget()
+    sequences.forget()
+
+    shop.app.config['TESTING'] = True
+    with shop.app.app_context():
+        yield shop.app
+        db.session.remove()
+
+
+@pytest.fixture
+def client(app):
+    client = app.test_client()
+    with client.session_transaction() as s:
+        s['user_id'] = 1
+        s['username'] = 'demo_shop'
+    return client
+
+
+def make_product(name, stock=0, price=10, cost=7, user_id=1):
+    """Add a product and bring it to `stock` through the ledger. Commits."""
+    product = Product(name=name, category='Other', unit='pc', selling_price=price,
+                      cost_price=cost, current_stock=0, user_id=user_id)
+    db.session.add(product)
+    db.session.flush()
+    if stock:
+        add_stock(product.id, stock)
+    db.session.commit()
+    return product.id
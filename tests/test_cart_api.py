@@ -0,0 +1,29 @@
+"""The cart line API validates what it stores."""
+import pytest
+
+from conftest import make_product
+from models import db, Product
+
+
+@pytest.fixture
+def cart_client(client):
+    assert client.post('/billing', data={'customer_name': 'Asha', 'customer_phone': '9000000001'}).status_code == 302
+    return client
+
+
+def test_numeric_barcode_is_looked_up(cart_client):
+    product_id = make_product('Rice', stock=10)
+    db.session.get(Product, product_id).barcode = '8901234567890'
+    db.session.commit()
+
+    response = cart_client.post('/api/cart/lines', json={'barcode': 8901234567890, 'qty': 2})
+    assert response.status_code == 200
+    assert response.get_json()['items'][0]['qty'] == 2
+
+
+@pytest.mark.parametrize('field, value', [('qty', 'inf'), ('qty', 'nan'), ('add', '-inf')])
+def test_non_finite_quantities_are_refused(cart_client, field, value):
+    product_id = make_product('Rice', stock=10)
+    response = cart_client.post('/api/cart/lines', json={'product_id': product_id, field: value})
+    assert response.status_code == 400
+    assert cart_client.get('/api/cart').get_json()['items'] == []
@@ -0,0 +1,30 @@
+"""/api/checkout reports a bad cart in its own errors entry and sells the rest."""
+from conftest import make_product
+from models import db, Product, Sale, Transaction
+
+
+def test_bad_customer_name_only_fails_its_cart(client):
+    product_id = make_product('Rice', stock=10)
+    response = client.post('/api/checkout', json={'carts': [
+        {'items': [{'product_id': product_id, 'qty': 1}], 'customer_name': 'Asha', 'customer_phone': '9000000001'},
+        {'items': [{'product_id': product_id, 'qty': 1}], 'customer_name': 12345, 'customer_phone': '9000000002'},
+        {'items': [{'product_id': product_id, 'qty': 1}], 'khata_description': ['x'], 'payment_method': 'Khata'},
+    ]})
+
+    assert response.status_code == 200
+    first, second, third = response.get_json()['results']
+    assert first['total_amount'] == 10
+    assert second == {'errors': ['customer_name must be a string']}
+    assert third == {'errors': ['khata_description must be a string']}
+
+    assert Transaction.query.count() == 1
+    assert Sale.query.count() == 1
+    assert db.session.get(Product, product_id).current_stock == 9
+
+
+def test_non_finite_quantity_is_refused(client):
+    product_id = make_product('Rice', stock=10)
+    response = client.post('/api/checkout', json={'items': [{'product_id': product_id, 'qty': 'inf'}]})
+
+    assert response.get_json()['results'] == [{'errors': [f'Quantity for product #{product_id} must be positive']}]
+    assert Sale.query.count() == 0
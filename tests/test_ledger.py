@@ -0,0 +1,47 @@
+"""Daily stock snapshots in a long-running process."""
+from datetime import datetime, timedelta
+
+import ledger
+import periods
+from conftest import make_product
+from models import db, Product, StockSnapshot
+from stock import take_stock
+
+
+def test_first_write_of_a_day_snapshots_its_opening_levels(app, monkeypatch):
+    monkeypatch.setattr(ledger, '_snapshot_day', None)
+    today = datetime.combine(periods.local_now().date(), datetime.min.time())
+    clock = {'now': today + timedelta(hours=10)}
+    monkeypatch.setattr(periods, 'local_now', lambda: clock['now'])
+
+    product_id = make_product('Rice', stock=50)
+    assert take_stock(product_id, 5)
+    db.session.commit()
+
+    # Next morning: the first sale snapshots the level the day opened with
+    clock['now'] = today + timedelta(days=1, hours=9)
+    assert take_stock(product_id, 3)
+    db.session.commit()
+    snapshot = db.session.get(StockSnapshot, {'product_id': product_id, 'day': clock['now'].date()})
+    assert snapshot is not None and snapshot.quantity == 45
+
+    # Later writes that day leave it alone
+    assert take_stock(product_id, 2)
+    db.session.commit()
+    assert StockSnapshot.query.filter_by(product_id=product_id).count() == 2
+    assert ledger.stock_as_of(product_id) == db.session.get(Product, product_id).current_stock == 40
+
+
+def test_rolled_back_snapshot_is_taken_again(app, monkeypatch):
+    product_id = make_product('Rice', stock=50)
+    db.session.execute(StockSnapshot.__table__.delete())
+    db.session.commit()
+    monkeypatch.setattr(ledger, '_snapshot_day', None)
+
+    assert take_stock(product_id, 5)
+    db.session.rollback()
+    assert StockSnapshot.query.count() == 0
+
+    assert take_stock(product_id, 5)
+    db.session.commit()
+    assert StockSnapshot.query.count() == 1
@@ -0,0 +1,81 @@
+"""Pages run a fixed number of SQL statements, however much history a shop has."""
+from contextlib import contextmanager
+from datetime import timedelta
+
+import pytest
+from sqlalchemy import event
+
+import periods
+from conftest import make_product
+from models import db, Sale
+from cache import invalidate_all, result_cache
+from analytics_engine import AnalyticsEngine
+
+# Statements per page with every cache cold
+BUDGETS = {
+    '/dashboard': 7,
+    '/inventory': 2,
+    '/api/analytics/summary': 4,
+    '/api/analytics/daily': 1,
+    '/api/analytics/monthly': 1,
+    '/api/analytics/weekday': 1,
+    '/api/analytics/heatmap': 2,
+    '/api/analytics/top_products': 1,
+    '/api/analytics/categories': 1,
+    '/api/analytics/last_7_days': 1,
+}
+
+
+@contextmanager
+def count_statements():
+    counter = {'n': 0}
+
+    def count(*args):
+        counter['n'] += 1
+
+    event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        yield counter
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count)
+
+
+def add_history(products, days):
+    """`products` products, each sold once a day for `days` days (today included)."""
+    now = periods.local_now()
+    ids = [make_product(f'Product {i}', stock=days + 1) for i in range(products)]
+    db.session.add_all([
+        Sale(product_id=pid, quantity=1, selling_price=10, cost_at_sale=7, total_amount=10,
+             date=now - timedelta(days=d), user_id=1)
+        for pid in ids for d in range(days)
+    ])
+    db.session.commit()
+
+
+def page_statements(client):
+    counts = {}
+    for path in BUDGETS:
+        invalidate_all()
+        result_cache.clear()
+        with count_statements() as counter:
+            assert client.get(path).status_code == 200
+        counts[path] = counter['n']
+    return counts
+
+
+@pytest.mark.parametrize('products, days', [(3, 5), (40, 400)])
+def test_pages_stay_within_budget(client, products, days):
+    add_history(products, days)
+    counts = page_statements(client)
+    assert {path: n for path, n in counts.items() if n > BUDGETS[path]} == {}
+
+
+def test_statement_count_does_not_grow_with_history(client):
+    add_history(2, 3)
+    small = page_statements(client)
+    add_history(30, 200)
+    assert page_statements(client) == small
+
+
+def test_every_analytics_section_has_a_budget():
+    assert {f'/api/analytics/{section}' for section in AnalyticsEngine.SECTIONS} <= set(BUDGETS)
@@ -0,0 +1,71 @@
+"""Period filters must stay index range scans on idx_sale_user_date."""
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+
+import app as shop
+import periods
+from models import db
+from kpi import load_counters
+from profit import profit_select
+
+INDEX_SCAN = 'USING INDEX idx_sale_user_date (user_id=? AND date>? AND date<?)'
+PERIODS = {
+    'today': periods.today,
+    'month': periods.this_month,
+    'ytd': periods.this_year,
+}
+
+
+def query_plan(sql, parameters=()):
+    connection = db.session.connection()
+    # EXPLAIN does not check the schema cookie: read the schema first so a
+    # pooled connection sees the indexes the fixture just recreated
+    connection.exec_driver_sql('SELECT count(*) FROM sqlite_master').all()
+    rows = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + sql, parameters).all()
+    return '\n'.join(row[-1] for row in rows)
+
+
+@contextmanager
+def sale_statements():
+    """Collect (sql, parameters) of every statement that reads the sale table."""
+    statements = []
+
+    def collect(conn, cursor, statement, parameters, context, executemany):
+        if 'FROM sale' in statement and not statement.startswith('EXPLAIN'):
+            statements.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', collect)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', collect)
+
+
+@pytest.mark.parametrize('name', PERIODS)
+def test_period_totals_use_the_index(app, name):
+    stmt = profit_select(user_id=1, period=PERIODS[name]())
+    compiled = stmt.compile(db.engine)
+    plan = query_plan(str(compiled), tuple(compiled.params[key] for key in compiled.positiontup))
+    assert INDEX_SCAN in plan, plan
+
+
+def test_kpi_counters_use_the_index(app):
+    # Today and month-to-date are summed inside the year-to-date range scan
+    with sale_statements() as statements:
+        load_counters(1)
+    period_queries = [(sql, params) for sql, params in statements if 'sale.date' in sql.partition('WHERE')[2]]
+    assert period_queries
+    for sql, params in period_queries:
+        plan = query_plan(sql, params)
+        assert INDEX_SCAN in plan, plan
+
+
+def test_todays_sales_feed_uses_the_index(app):
+    with sale_statements() as statements:
+        shop.todays_sales_page(1)
+    assert statements
+    for sql, params in statements:
+        plan = query_plan(sql, params)
+        assert INDEX_SCAN in plan, plan
@@ -0,0 +1,61 @@
+"""Invoice numbers from sequence_counter across workers and threads."""
+import threading
+
+import pytest
+from sqlalchemy.exc import IntegrityError
+
+from models import db, Transaction
+from sequences import SequenceAllocator
+
+WORKERS = 4
+THREADS_PER_WORKER = 4
+NUMBERS = 100
+
+
+def test_numbers_are_unique_and_increase_per_worker(app):
+    # Separate allocators stand in for separate worker processes
+    allocators = [SequenceAllocator() for _ in range(WORKERS)]
+    taken = {}
+    failures = []
+
+    def run(worker, thread):
+        with app.app_context():
+            try:
+                taken[worker, thread] = [int(allocators[worker].next(1, 'invoice')) for _ in range(NUMBERS)]
+            except Exception as e:
+                failures.append(repr(e))
+
+    threads = [threading.Thread(target=run, args=(w, t)) for w in range(WORKERS) for t in range(THREADS_PER_WORKER)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert failures == []
+    numbers = [n for run_numbers in taken.values() for n in run_numbers]
+    assert len(numbers) == WORKERS * THREADS_PER_WORKER * NUMBERS
+    assert len(set(numbers)) == len(numbers)
+    for run_numbers in taken.values():
+        assert run_numbers == sorted(run_numbers)
+        assert len(set(run_numbers)) == len(run_numbers)
+
+    # Whole blocks, not one reservation per number
+    assert sum(a.reservations for a in allocators) <= len(numbers) // allocators[0].block_size + WORKERS
+
+
+def test_numbers_are_formatted_per_shop(app):
+    allocator = SequenceAllocator(block_size=5)
+    assert allocator.take(1, 'invoice', 3) == ['000001', '000002', '000003']
+    assert allocator.next(1, 'khata_receipt') == 'KP000001'
+    assert allocator.next(2, 'invoice') == '000001'
+
+
+def test_transaction_refs_are_unique_per_shop(app):
+    db.session.add(Transaction(txn_type='invoice', txn_ref='000001', amount=10, user_id=1))
+    db.session.add(Transaction(txn_type='invoice', txn_ref='000001', amount=10, user_id=2))
+    db.session.commit()
+
+    db.session.add(Transaction(txn_type='invoice', txn_ref='000001', amount=20, user_id=1))
+    with pytest.raises(IntegrityError):
+        db.session.commit()
+    db.session.rollback()
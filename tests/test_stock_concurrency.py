@@ -0,0 +1,64 @@
+"""Concurrent checkouts against shared stock: no lost updates, no half-sold carts."""
+import json
+import threading
+
+from conftest import make_product
+from models import db, Product, Sale, Transaction
+from checkout import Cart, CheckoutError, checkout
+from ledger import stock_levels, reconcile_current_stock
+
+THREADS = 8
+CARTS_PER_THREAD = 10
+
+
+def test_concurrent_checkouts_keep_stock_exact(app):
+    common = make_product('Rice', stock=100)
+    scarce = make_product('Saffron', stock=5)
+
+    outcomes = []
+    failures = []
+
+    def counter(i):
+        with app.app_context():
+            for j in range(CARTS_PER_THREAD):
+                # Every other cart also wants the scarce product, which runs out
+                items = [{'id': common, 'qty': 1}]
+                if j % 2:
+                    items.append({'id': scarce, 'qty': 1})
+                try:
+                    outcomes.append(('sold', len(items), checkout(1, Cart(items=items))['invoice_no']))
+                except CheckoutError:
+                    outcomes.append(('refused', len(items), None))
+                except Exception as e:  # locking errors and the like fail the test
+                    failures.append(repr(e))
+
+    threads = [threading.Thread(target=counter, args=(i,)) for i in range(THREADS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert failures == []
+    assert len(outcomes) == THREADS * CARTS_PER_THREAD
+    sold = [o for o in outcomes if o[0] == 'sold']
+    sold_pairs = sum(1 for o in sold if o[1] == 2)
+    # Single-product carts never run short; only the scarce carts are refused
+    assert all(o[1] == 2 for o in outcomes if o[0] == 'refused')
+    assert sold_pairs == 5
+
+    db.session.expire_all()
+    assert db.session.get(Product, common).current_stock == 100 - len(sold)
+    assert db.session.get(Product, scarce).current_stock == 0
+
+    # Every sold cart has all of its lines and one invoice; refused carts left nothing
+    invoices = Transaction.query.filter_by(txn_type='invoice').all()
+    assert sorted(t.txn_ref for t in invoices) == sorted(o[2] for o in sold)
+    assert len({o[2] for o in sold}) == len(sold)
+    assert Sale.query.count() == sum(len(json.loads(t.data)['items']) for t in invoices)
+    assert Sale.query.filter_by(product_id=common).count() == len(sold)
+    assert Sale.query.filter_by(product_id=scarce).count() == sold_pairs
+
+    # The ledger saw exactly the same movements
+    levels = stock_levels(product_ids=[common, scarce])
+    assert levels == {common: 100.0 - len(sold), scarce: 0.0}
+    assert reconcile_current_stock(1) == []
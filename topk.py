@@ -0,0 +1,252 @@
+"""Best-selling products per user, maintained incrementally.
+
+Each user has one Ranking per window (today, the last 30 days, all time),
+seeded from daily_product_rollup by a single grouped query and then moved
+by every committed Sale insert or delete, so reading a top-K list is a
+slice of an already sorted index.
+
+The 30-day window slides by subtracting the rollup rows of the days that
+fell out of it when the date changes; the today window simply resets.
+rebuild() reloads a user from the database on demand, and cache.py's
+invalidate_all() drops everything after out-of-band bulk writes.
+"""
+from bisect import bisect_left, insort
+from datetime import timedelta
+import threading
+
+from sqlalchemy import case, event, func
+from sqlalchemy.orm import Session
+
+from models import db, Product, Sale, DailyProductRollup
+import periods
+
+WINDOWS = {'today': 1, '30d': 30, 'all': None}  # window name -> length in days
+METRICS = ('revenue', 'quantity')
+
+
+class Ranking:
+    """Per-product quantity/revenue totals with an index sorted for each metric."""
+
+    def __init__(self):
+        self.totals = {}
+        # (-value, product_id): best first, ties broken by product id
+        self._index = {metric: [] for metric in METRICS}
+
+    def add(self, product_id, quantity, revenue):
+        old = self.totals.get(product_id)
+        if old is not None:
+            for metric, value in zip(METRICS, (old[1], old[0])):
+                index = self._index[metric]
+                del index[bisect_left(index, (-value, product_id))]
+            quantity += old[0]
+            revenue += old[1]
+
+        if abs(quantity) < 1e-9 and abs(revenue) < 1e-6:
+            self.totals.pop(product_id, None)
+            return
+        self.totals[product_id] = (quantity, revenue)
+        insort(self._index['revenue'], (-revenue, product_id))
+        insort(self._index['quantity'], (-quantity, product_id))
+
+    def top(self, k, by='revenue'):
+        """[(product_id, quantity, revenue)] for the k best products by `by`."""
+        return [(pid,) + self.totals[pid] for _, pid in self._index[by][:k]]
+
+
+class UserRankings:
+    def __init__(self, day):
+        self.day = day
+        self.windows = {name: Ranking() for name in WINDOWS}
+
+    def window_start(self, name):
+        length = WINDOWS[name]
+        return None if length is None else self.day - timedelta(days=length - 1)
+
+    def add(self, when, product_id, quantity, revenue):
+        sale_day = when.date() if when is not None else None
+        for name, ranking in self.windows.items():
+            start = self.window_start(name)
+            if start is None or (sale_day is not None and sale_day >= start):
+                ranking.add(product_id, quantity, revenue)
+
+
+def _rollup_totals(user_id, first_day=None, end_day=None):
+    """{product_id: (qty, revenue)} from the rollup for [first_day, end_day)."""
+    R = DailyProductRollup
+    query = db.session.query(R.product_id, func.sum(R.qty), func.sum(R.revenue)).filter(R.user_id == user_id)
+    if first_day is not None:
+        query = query.filter(R.day >= first_day)
+    if end_day is not None:
+        query = query.filter(R.day < end_day)
+    return {pid: (float(qty or 0), float(rev or 0)) for pid, qty, rev in query.group_by(R.product_id)}
+
+
+def load_rankings(user_id, day):
+    """Seed every window for one user with a single grouped rollup query."""
+    R = DailyProductRollup
+    rankings = UserRankings(day)
+
+    columns = []
+    for name in WINDOWS:
+        start = rankings.window_start(name)
+        if start is None:
+            columns += [func.sum(R.qty), func.sum(R.revenue)]
+        else:
+            in_window = R.day >= start
+            columns += [func.sum(case((in_window, R.qty), else_=0)),
+                        func.sum(case((in_window, R.revenue), else_=0))]
+
+    rows = db.session.query(R.product_id, *columns).filter(
+        R.user_id == user_id
+    ).group_by(R.product_id).all()
+
+    for row in rows:
+        values = row[1:]
+        for i, ranking in enumerate(rankings.windows.values()):
+            qty, revenue = float(values[2 * i] or 0), float(values[2 * i + 1] or 0)
+            if qty or revenue:
+                ranking.add(row.product_id, qty, revenue)
+    return rankings
+
+
+class TopProducts:
+    """Thread-safe per-user rankings plus a product name cache."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._users = {}
+        self._names = {}
+
+    def top(self, user_id, window='all', k=5, by='revenue', now=None):
+        """[{'product_id', 'name', 'quantity', 'revenue'}] best first."""
+        if window not in WINDOWS:
+            raise ValueError(f'unknown window {window!r}')
+        if by not in METRICS:
+            raise ValueError(f'unknown metric {by!r}')
+        today = (now or periods.local_now()).date()
+        rankings = self._rankings(user_id, today)
+        with self._lock:
+            rows = rankings.windows[window].top(k, by)
+        names = self._product_names([pid for pid, _, _ in rows])
+        return [
+            {'product_id': pid, 'name': names.get(pid), 'quantity': qty, 'revenue': revenue}
+            for pid, qty, revenue in rows
+        ]
+
+    def rebuild(self, user_id, now=None):
+        """Reload a user's rankings from the rollup."""
+        today = (now or periods.local_now()).date()
+        rankings = load_rankings(user_id, today)
+        with self._lock:
+            self._users[user_id] = rankings
+        return rankings
+
+    def forget(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                self._users.clear()
+                self._names.clear()
+            else:
+                self._users.pop(user_id, None)
+
+    def forget_names(self, product_ids):
+        with self._lock:
+            for pid in product_ids:
+                self._names.pop(pid, None)
+
+    def apply(self, deltas):
+        """Fold committed sale deltas [(user_id, when, product_id, qty, revenue)] into loaded rankings."""
+        with self._lock:
+            for user_id, when, product_id, qty, revenue in deltas:
+                rankings = self._users.get(user_id)
+                if rankings is not None:
+                    rankings.add(when, product_id, qty, revenue)
+
+    def _rankings(self, user_id, today):
+        with self._lock:
+            rankings = self._users.get(user_id)
+        if rankings is None or today - rankings.day >= timedelta(days=WINDOWS['30d']):
+            rankings = load_rankings(user_id, today)
+            with self._lock:
+                self._users[user_id] = rankings
+            return rankings
+        if today > rankings.day:
+            self._slide(user_id, rankings, today)
+        return rankings
+
+    def _slide(self, user_id, rankings, today):
+        """Move a user's windows forward to `today`, expiring days through the rollup."""
+        old_start = rankings.window_start('30d')
+        new_start = today - timedelta(days=WINDOWS['30d'] - 1)
+        expired = _rollup_totals(user_id, old_start, new_start)
+        # Sales already made today may have landed before the slide, so reseed rather than reset
+        todays = _rollup_totals(user_id, today)
+        with self._lock:
+            if rankings.day >= today:
+                return  # another request already slid it
+            window = rankings.windows['30d']
+            for pid, (qty, revenue) in expired.items():
+                window.add(pid, -qty, -revenue)
+            rankings.windows['today'] = Ranking()
+            for pid, (qty, revenue) in todays.items():
+                rankings.windows['today'].add(pid, qty, revenue)
+            rankings.day = today
+
+    def _product_names(self, product_ids):
+        with self._lock:
+            missing = [pid for pid in product_ids if pid not in self._names]
+        if missing:
+            found = dict(db.session.query(Product.id, Product.name).filter(Product.id.in_(missing)))
+            with self._lock:
+                self._names.update(found)
+        with self._lock:
+            return {pid: self._names.get(pid) for pid in product_ids}
+
+
+top_products = TopProducts()
+
+
+def note_sales(session, sales):
+    """Queue sales inserted with Core [(user_id, when, product_id, qty, revenue)], applied at commit."""
+    session.info.setdefault('topk_deltas', []).extend(
+        (int(user_id), when, int(product_id), float(qty or 0), float(revenue or 0))
+        for user_id, when, product_id, qty, revenue in sales
+    )
+
+
+# ===== WRITE TRACKING =====
+# Same pattern as cache.py and kpi.py: collect at flush, apply once committed.
+@event.listens_for(Session, 'after_flush')
+def _collect_ranking_deltas(session, flush_context):
+    deltas = session.info.setdefault('topk_deltas', [])
+    stale = session.info.setdefault('topk_stale_users', set())
+    renamed = session.info.setdefault('topk_renamed_products', set())
+    for obj in session.new:
+        if isinstance(obj, Sale) and obj.user_id is not None and obj.product_id is not None:
+            deltas.append((int(obj.user_id), obj.date, int(obj.product_id),
+                           float(obj.quantity or 0), float(obj.total_amount or 0)))
+    for obj in session.deleted:
+        if isinstance(obj, Sale) and obj.user_id is not None and obj.product_id is not None:
+            deltas.append((int(obj.user_id), obj.date, int(obj.product_id),
+                           -float(obj.quantity or 0), -float(obj.total_amount or 0)))
+        elif isinstance(obj, Product):
+            renamed.add(obj.id)
+    for obj in session.dirty:
+        if isinstance(obj, Sale) and obj.user_id is not None and session.is_modified(obj):
+            stale.add(int(obj.user_id))
+        elif isinstance(obj, Product) and session.is_modified(obj):
+            renamed.add(obj.id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_ranking_deltas(session):
+    top_products.apply(session.info.pop('topk_deltas', ()))
+    for user_id in session.info.pop('topk_stale_users', ()):
+        top_products.forget(user_id)
+    top_products.forget_names(session.info.pop('topk_renamed_products', ()))
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_ranking_deltas(session):
+    for key in ('topk_deltas', 'topk_stale_users', 'topk_renamed_products'):
+        session.info.pop(key, None)